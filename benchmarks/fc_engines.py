@@ -0,0 +1,60 @@
+# Compare the batched sliding-window ARIMA engine against the Sarimax path
+# on copper opening prices from data_staged.  Run from the repo root:
+#   python -m benchmarks.fc_engines --steps 500
+import argparse
+import time
+import warnings
+import numpy as np
+import pandas as pd
+import methods.fc as fc
+
+
+def load_copper_open(path : str = 'data_staged/copper.csv') -> np.ndarray:
+    df = pd.read_csv(path, thousands=',')
+    df['Date'] = pd.to_datetime(df['Date'], format='%m/%d/%Y')
+    return df.sort_values('Date')['Open'].to_numpy(dtype=np.float64)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--steps', type=int, default=500, help='prediction steps for the Sarimax path')
+    parser.add_argument('--window-size', type=int, default=12)
+    args = parser.parse_args()
+
+    y = load_copper_open()
+    y_sample = y[:args.steps + args.window_size]
+
+    for pdq in [(1,1,1), (1,2,1)]:
+        print('pdq=' + str(pdq) + ', window_size=' + str(args.window_size))
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            start = time.perf_counter()
+            sarimax_preds = fc.get_sliding_window_arima_values(y_sample, pdq, args.window_size)
+            sarimax_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batched_preds = fc.get_sliding_window_arima_values(y_sample, pdq, args.window_size, engine='batched')
+        batched_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        fc.get_sliding_window_arima_values(y, pdq, args.window_size, engine='batched')
+        batched_full_seconds = time.perf_counter() - start
+
+        actual = y_sample[args.window_size:]
+        prev = y_sample[args.window_size-1:-1]
+        for name, preds, seconds in [('sarimax', sarimax_preds, sarimax_seconds), 
+                                     ('batched', batched_preds, batched_seconds)]:
+            preds = preds[args.window_size:]
+            mae = np.nanmean(np.abs(actual - preds))
+            sign_product = np.nanmean(np.sign(actual - prev) * np.sign(preds - prev))
+            print('  ' + name.ljust(8) + ' ' + str(round(seconds, 3)).rjust(8) + ' s'
+                  + '   MAE ' + str(round(mae, 5)) + '   mean sign product ' + str(round(sign_product, 4)))
+
+        print('  mean |sarimax - batched|:  ' + str(round(np.nanmean(np.abs(sarimax_preds - batched_preds)), 5)))
+        print('  speedup:  ' + str(round(sarimax_seconds / batched_seconds, 1)) + 'x')
+        print('  batched, all ' + str(len(y)) + ' rows:  ' + str(round(batched_full_seconds, 3)) + ' s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+# Timings for the methods hot paths on synthetic data at 1x, 10x and 100x
+# the size of data_staged (see benchmarks/synthetic.py), written as JSON so
+# runs on different commits can be compared.  Run from the repo root:
+#   python -m benchmarks.suite --scales 1 10
+#   python -m benchmarks.suite --scales 1 10 --compare data_cache/benchmarks/<old commit>.json
+#
+# Wide steps (ingest, merge, forward fill, annual decomposition) scale the
+# number of datasets; series steps (ARIMA, eval columns, agents) scale the
+# length of one target series
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import time
+import warnings
+import numpy as np
+import pandas as pd
+import ibis
+import duckdb
+import methods.prep as prep
+import methods.fc as fc
+import methods.sim as sim
+from methods import db
+from benchmarks import synthetic
+
+
+BENCHMARK_NAMES = [
+    'ingest_staged_csvs',
+    'merge_tables_pivot',
+    'merge_tables_sequential',
+    'impute_forward_fill_numerics',
+    'annual_decomposition',
+    'sliding_window_arima_batched',
+    'sliding_window_arima_sarimax',
+    'add_fc_eval_columns',
+    'portfolio_agent_step',
+    'run_experiment',
+]
+
+TARGET_NAME = 'COPPER_OPEN'
+
+
+# Seconds for each of repeats calls to run(), with setup() (untimed) before each
+def time_repeats(
+        run,
+        repeats : int,
+        setup = None) -> list[float]:
+    seconds = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+# Run a lazy ibis expression to completion inside DuckDB, without pulling
+# a possibly very wide result into pandas
+def materialize(
+        table : ibis.Table,
+        name : str) -> ibis.Table:
+    return db.register_table(name, table)
+
+
+def get_environment() -> dict:
+    def git(*args):
+        try:
+            return subprocess.run(['git', *args], capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    return {
+        'commit' : git('rev-parse', 'HEAD'),
+        'dirty' : bool(git('status', '--porcelain', '--untracked-files=no')),
+        'timestamp' : datetime.datetime.now().isoformat(timespec='seconds'),
+        'platform' : platform.platform(),
+        'processor' : platform.processor(),
+        'cpu_count' : os.cpu_count(),
+        'python' : platform.python_version(),
+        'numpy' : np.__version__,
+        'pandas' : pd.__version__,
+        'ibis' : ibis.__version__,
+        'duckdb' : duckdb.__version__,
+    }
+
+
+# Wide benchmarks for one scale: ingest the synthetic files, merge them,
+# forward fill and decompose the merge.  Each step's output feeds the next
+def run_wide_benchmarks(
+        scale : int,
+        work_dir : str,
+        selected : list[str],
+        repeats : int,
+        max_decomp_features : int) -> list[dict]:
+    staged_path = os.path.join(work_dir, 'staged_' + str(scale))
+    cache_dir = os.path.join(work_dir, 'ingest_' + str(scale))
+    if not os.path.exists(os.path.join(staged_path, 'COMPLETE')):
+        shutil.rmtree(staged_path, ignore_errors=True)
+        names = synthetic.write_synthetic_staged_data(staged_path, scale)
+        with open(os.path.join(staged_path, 'COMPLETE'), 'w') as f:
+            json.dump(names, f)
+    with open(os.path.join(staged_path, 'COMPLETE')) as f:
+        fred_names, inv_names, traded = json.load(f)
+    dataset_names = fred_names + inv_names
+    num_source_rows = sum(len(pd.read_csv(os.path.join(staged_path, name + '.csv'), usecols=[0]))
+                          for name in dataset_names)
+
+    results = []
+    def record(name, seconds, **sizes):
+        results.append({'benchmark' : name, 'scale' : scale, 'seconds' : seconds, **sizes})
+
+    def ingest():
+        prep.ingest_staged_csvs(staged_path, cache_dir, fred_names, inv_names, traded)
+    if 'ingest_staged_csvs' in selected:
+        seconds = time_repeats(ingest, repeats, setup=lambda: shutil.rmtree(cache_dir, ignore_errors=True))
+        record('ingest_staged_csvs', seconds, datasets=len(dataset_names), rows=num_source_rows)
+    elif not os.path.exists(os.path.join(cache_dir, 'manifest.json')):
+        ingest()
+
+    tables = prep.load_ingested_tables(dataset_names, cache_dir)
+
+    wide_steps = ['merge_tables_pivot', 'merge_tables_sequential', 'impute_forward_fill_numerics', 'annual_decomposition']
+    if not any(name in selected for name in wide_steps):
+        return results
+
+    # The join chain takes minutes at a few hundred tables, so it's only
+    # timed at 1x
+    if 'merge_tables_sequential' in selected and scale == 1:
+        seconds = time_repeats(
+            lambda: materialize(prep.merge_tables(tables, 'outer', False, 'sequential'), 'bench_merged'),
+            repeats)
+        record('merge_tables_sequential', seconds, datasets=len(dataset_names))
+
+    def merge():
+        return materialize(prep.merge_tables(tables, 'outer', False, 'pivot'), 'bench_merged')
+
+    if 'merge_tables_pivot' in selected:
+        seconds = time_repeats(merge, repeats)
+        record('merge_tables_pivot', seconds, datasets=len(dataset_names))
+    else:
+        merge()
+    merged = db.get_table('bench_merged')
+    merged_rows = int(merged.count().execute())
+
+    def ffill():
+        return materialize(prep.impute_forward_fill_numerics(merged), 'bench_ffilled')
+
+    if 'impute_forward_fill_numerics' in selected:
+        seconds = time_repeats(ffill, repeats)
+        record('impute_forward_fill_numerics', seconds, rows=merged_rows, columns=len(merged.columns))
+    elif 'annual_decomposition' in selected:
+        ffill()
+
+    # One feature per Investing.com dataset, like the notebook's opening
+    # prices, up to max_decomp_features.  The PIVOT builds its whole output
+    # (a column per feature and year) in memory without spilling, so all
+    # 1000 at 100x don't fit on a small box
+    if 'annual_decomposition' in selected:
+        ffilled = db.get_table('bench_ffilled')
+        decomp_features = [name + '_OPEN' for name in inv_names][:max_decomp_features]
+        seconds = time_repeats(
+            lambda: materialize(prep.annual_decomposition(ffilled, decomp_features), 'bench_decomp'),
+            repeats)
+        record('annual_decomposition', seconds, rows=merged_rows, features=len(decomp_features))
+
+    for name in ['bench_merged', 'bench_ffilled', 'bench_decomp']:
+        db.drop_table(name)
+    return results
+
+
+# Series benchmarks for one scale, on a single target scale times as long
+# as the staged copper history
+def run_series_benchmarks(
+        scale : int,
+        selected : list[str],
+        repeats : int,
+        arima_steps : int,
+        num_agents : int,
+        max_workers : int) -> list[dict]:
+    df = synthetic.make_synthetic_target_frame(scale, TARGET_NAME)
+    y = df[TARGET_NAME].to_numpy()
+    bins_col = TARGET_NAME + '_PROPDELTA_PRED_BIN'
+    price_delta_col = TARGET_NAME + '_PROPDELTA'
+
+    results = []
+    def record(name, seconds, **sizes):
+        results.append({'benchmark' : name, 'scale' : scale, 'seconds' : seconds, **sizes})
+
+    if 'sliding_window_arima_batched' in selected:
+        seconds = time_repeats(
+            lambda: fc.sliding_window_arima_predictions(df[['DATE', TARGET_NAME]].copy(), TARGET_NAME, (1,2,1), 12, engine='batched'),
+            repeats)
+        record('sliding_window_arima_batched', seconds, rows=len(df))
+
+    # Statsmodels fits one window at a time, so only the first arima_steps
+    # predictions are timed whatever the scale; compare per-step rates
+    if 'sliding_window_arima_sarimax' in selected:
+        y_sample = y[:arima_steps + 12]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            seconds = time_repeats(
+                lambda: fc.get_sliding_window_arima_values(y_sample, (1,2,1), 12, max_workers=max_workers),
+                repeats)
+        record('sliding_window_arima_sarimax', seconds, rows=len(y_sample), steps=arima_steps)
+
+    if 'add_fc_eval_columns' in selected:
+        eval_df = df[['DATE', TARGET_NAME, TARGET_NAME + '_PRED']]
+        seconds = time_repeats(lambda: fc.add_fc_eval_columns(eval_df.copy(), TARGET_NAME), repeats)
+        record('add_fc_eval_columns', seconds, rows=len(df))
+
+    agent_params = {
+        'date_col' : 'DATE',
+        'price_delta_pred_bins_col' : bins_col,
+        'price_delta_col' : price_delta_col,
+        'learning_rate' : 0.05,
+        'explore_chance' : 0.3}
+
+    if 'portfolio_agent_step' in selected:
+        agent = None
+        def make_agent():
+            nonlocal agent
+            agent = sim.PortfolioAgent(df, **agent_params)
+        def run_agent():
+            while agent.step(exploring=True, learning=True, learning_lookback_steps=5):
+                pass
+        seconds = time_repeats(run_agent, repeats, setup=make_agent)
+        record('portfolio_agent_step', seconds, steps=len(df) - 1)
+
+    if 'run_experiment' in selected:
+        seconds = time_repeats(
+            lambda: sim.run_experiment(df, num_agents=num_agents, max_workers=max_workers, **agent_params),
+            repeats)
+        record('run_experiment', seconds, steps=len(df) - 1, agents=num_agents)
+
+    return results
+
+
+def summarize(result : dict) -> dict:
+    seconds = result['seconds']
+    return {**result, 'min_seconds' : min(seconds), 'median_seconds' : float(np.median(seconds))}
+
+
+# Median seconds of each (benchmark, scale) in results relative to baseline
+def compare_results(
+        results : list[dict],
+        baseline : list[dict]) -> pd.DataFrame:
+    baseline_seconds = {(row['benchmark'], row['scale']) : row['median_seconds'] for row in baseline}
+    rows = []
+    for row in results:
+        old_seconds = baseline_seconds.get((row['benchmark'], row['scale']))
+        rows.append({
+            'benchmark' : row['benchmark'],
+            'scale' : row['scale'],
+            'baseline_seconds' : old_seconds,
+            'median_seconds' : row['median_seconds'],
+            'ratio' : row['median_seconds'] / old_seconds if old_seconds else np.nan})
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10], help='1, 10 and/or 100')
+    parser.add_argument('--benchmarks', nargs='+', default=BENCHMARK_NAMES, choices=BENCHMARK_NAMES)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--arima-steps', type=int, default=200, help='prediction steps for the Sarimax path')
+    parser.add_argument('--num-agents', type=int, default=100)
+    parser.add_argument('--max-decomp-features', type=int, default=100)
+    parser.add_argument('--max-workers', type=int, default=None)
+    parser.add_argument('--work-dir', default='data_cache/benchmarks/work')
+    parser.add_argument('--memory-limit', default=None, help="DuckDB memory limit, e.g. '4GB'; it spills to the work dir past this")
+    parser.add_argument('--output', default=None, help='defaults to data_cache/benchmarks/<commit>.json')
+    parser.add_argument('--compare', default=None, help='earlier results JSON to compare against')
+    args = parser.parse_args()
+
+    db.configure(memory_limit=args.memory_limit, temp_directory=os.path.join(args.work_dir, 'duckdb_tmp'))
+    environment = get_environment()
+    results = []
+    for scale in args.scales:
+        print('Scale ' + str(scale) + 'x')
+        for result in (run_wide_benchmarks(scale, args.work_dir, args.benchmarks, args.repeats, args.max_decomp_features)
+                       + run_series_benchmarks(scale, args.benchmarks, args.repeats,
+                                               args.arima_steps, args.num_agents, args.max_workers)):
+            result = summarize(result)
+            results.append(result)
+            print('  ' + result['benchmark'].ljust(30) + str(round(result['median_seconds'], 4)).rjust(10) + ' s')
+
+    output = args.output
+    if output is None:
+        output = os.path.join('data_cache/benchmarks', (environment['commit'] or 'results')[:10] + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            'environment' : environment,
+            'settings' : {key : value for key, value in vars(args).items() if key not in ['output', 'compare']},
+            'results' : results}, f, indent=2)
+    print('Wrote ' + output)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(compare_results(results, baseline['results']).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+# Synthetic stand-ins for data_staged, for benchmarking at sizes the real
+# data doesn't reach.  Files have the same shapes as the staged ones
+# (Investing.com: quoted, newest first, thousands separators, Vol. and
+# Change % columns; FRED: DATE plus one series column, '.' for missing),
+# the same calendars and roughly the same price levels, so they go
+# through prep's ingest unchanged.  Scale N writes N copies of every
+# staged dataset (COPPER, COPPER1, ...); copy 0 of each traded commodity
+# keeps its trading-day flag
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import methods.prep as prep
+
+
+# Dates and starting level of a staged dataset, oldest first
+def read_staged_calendar(
+        data_path : str,
+        dataset_name : str,
+        source_kind : str) -> tuple[pd.DatetimeIndex, float]:
+    source_path = prep.find_staged_file(data_path, dataset_name)
+    if source_kind == 'fred':
+        df = pd.read_csv(source_path, na_values='.')
+        dates = pd.to_datetime(df['DATE'], format='mixed')
+        values = pd.to_numeric(df.iloc[:, 1], errors='coerce')
+    else:
+        df = pd.read_csv(source_path, thousands=',', encoding='utf-8-sig')
+        dates = pd.to_datetime(df['Date'], format='%m/%d/%Y')
+        values = df['Open']
+    order = np.argsort(dates.to_numpy())
+    values = values.to_numpy(dtype=np.float64)[order]
+    start_level = values[~np.isnan(values)][0]
+    return pd.DatetimeIndex(dates.to_numpy()[order]), float(start_level)
+
+
+# Geometric random walk with the given number of steps and starting level
+def get_random_walk(
+        rng : np.random.Generator,
+        num_steps : int,
+        start_level : float,
+        volatility : float = 0.015) -> np.ndarray:
+    log_steps = rng.normal(0, volatility, num_steps)
+    log_steps[0] = 0
+    return start_level * np.exp(np.cumsum(log_steps))
+
+
+def format_prices(values : np.ndarray) -> list[str]:
+    return ['{:,.4f}'.format(value) for value in values]
+
+
+def write_inv_csv(
+        path : str,
+        dates : pd.DatetimeIndex,
+        start_level : float,
+        rng : np.random.Generator):
+    close = get_random_walk(rng, len(dates), start_level)
+    open_ = np.concatenate([[start_level], close[:-1]]) * np.exp(rng.normal(0, 0.003, len(dates)))
+    high = np.maximum(open_, close) * np.exp(np.abs(rng.normal(0, 0.005, len(dates))))
+    low = np.minimum(open_, close) * np.exp(-np.abs(rng.normal(0, 0.005, len(dates))))
+    volume = rng.uniform(1, 300, len(dates))
+    change = np.concatenate([[0], close[1:] / close[:-1] - 1]) * 100
+
+    df = pd.DataFrame({
+        'Date' : dates.strftime('%m/%d/%Y'),
+        'Price' : format_prices(close),
+        'Open' : format_prices(open_),
+        'High' : format_prices(high),
+        'Low' : format_prices(low),
+        'Vol.' : ['{:.2f}K'.format(value) for value in volume],
+        'Change %' : ['{:.2f}%'.format(value) for value in change]})
+
+    # Newest first, like the downloads
+    df.iloc[::-1].to_csv(path, index=False, quoting=1, encoding='utf-8-sig')
+
+
+def write_fred_csv(
+        path : str,
+        dataset_name : str,
+        dates : pd.DatetimeIndex,
+        start_level : float,
+        rng : np.random.Generator,
+        missing_chance : float = 0.01):
+    values = get_random_walk(rng, len(dates), start_level, volatility=0.005)
+    values = ['{:.3f}'.format(value) for value in values]
+    for i in np.flatnonzero(rng.random(len(dates)) < missing_chance):
+        values[i] = '.'
+    pd.DataFrame({
+        'DATE' : dates.strftime('%Y-%m-%d'),
+        dataset_name : values}).to_csv(path, index=False)
+
+
+# Write scale copies of every staged dataset to output_path.  Returns
+# (fred_dataset_names, inv_dataset_names, traded_commodities) for
+# prep.ingest_staged_csvs
+def write_synthetic_staged_data(
+        output_path : str,
+        scale : int = 1,
+        data_path : str = 'data_staged/',
+        fred_dataset_names : list[str] = prep.FRED_DATASET_NAMES,
+        inv_dataset_names : list[str] = prep.INV_DATASET_NAMES,
+        traded_commodities : list[str] = prep.TRADED_COMMODITIES,
+        seed : int = 42) -> tuple[list[str], list[str], list[str]]:
+    os.makedirs(output_path, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    synthetic_names = {'fred' : [], 'inv' : []}
+    for source_kind, dataset_names in [('fred', fred_dataset_names), ('inv', inv_dataset_names)]:
+        for dataset_name in dataset_names:
+            dates, start_level = read_staged_calendar(data_path, dataset_name, source_kind)
+            for copy_ind in range(scale):
+                copy_name = dataset_name + (str(copy_ind) if copy_ind > 0 else '')
+                path = os.path.join(output_path, copy_name + '.csv')
+                if source_kind == 'fred':
+                    write_fred_csv(path, copy_name, dates, start_level, rng)
+                else:
+                    write_inv_csv(path, dates, start_level, rng)
+                synthetic_names[source_kind].append(copy_name)
+
+    return synthetic_names['fred'], synthetic_names['inv'], list(traded_commodities)
+
+
+# A single target series scale times as long as the staged copper history,
+# with the columns the forecasting and decisioning steps work on:
+#   DATE (hourly, since daily dates would run past pandas' range at 100x),
+#   <target_name>, <target_name>_PRED (a noisy one-step forecast),
+#   _PROPDELTA (the realized change agents are rewarded on) and the
+#   _PROPDELTA_PRED / _PROPDELTA_PRED_BIN columns they decide on
+def make_synthetic_target_frame(
+        scale : int = 1,
+        target_name : str = 'COPPER_OPEN',
+        data_path : str = 'data_staged/',
+        num_bins : int = 11,
+        seed : int = 42) -> pd.DataFrame:
+    dates, start_level = read_staged_calendar(data_path, 'COPPER', 'inv')
+    num_rows = len(dates) * scale
+    rng = np.random.default_rng(seed)
+
+    y = get_random_walk(rng, num_rows, start_level)
+    # Forecast from past values only, so agents can't compound a look-ahead
+    # edge over a long series
+    prev = np.concatenate([[np.nan], y[:-1]])
+    prev_delta = np.concatenate([[np.nan], np.diff(prev)])
+    pred = prev + prev_delta * 0.3 + rng.normal(0, 0.01 * start_level, num_rows)
+
+    df = pd.DataFrame({
+        'DATE' : pd.date_range('1970-01-01', periods=num_rows, freq='h'),
+        target_name : y,
+        target_name + '_PRED' : pred})
+    df[target_name + '_PROPDELTA'] = np.nan_to_num((y - prev) / prev)
+    prop_delta_pred = (pred - prev) / prev
+    breakpoints = np.nanquantile(prop_delta_pred, np.linspace(0, 1, num_bins + 1)[1:-1])
+    df[target_name + '_PROPDELTA_PRED'] = np.nan_to_num(prop_delta_pred)
+    df[target_name + '_PROPDELTA_PRED_BIN'] = np.searchsorted(breakpoints, df[target_name + '_PROPDELTA_PRED'], side='right')
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output_path')
+    parser.add_argument('--scale', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    fred_names, inv_names, _ = write_synthetic_staged_data(args.output_path, args.scale, seed=args.seed)
+    print('Wrote ' + str(len(fred_names) + len(inv_names)) + ' datasets to ' + args.output_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+# Walk-forward backtest over yearly folds: each fold trains on the years
+# before its test year (all of them since first_train_year, or the last
+# train_years for rolling folds), then is scored on the test year.  Per fold:
+# forecast -> bin -> agent training on the train years -> greedy evaluation
+# on the test year.  From the repo root:
+#   python -m methods.backtest --first-test-year 2013 --last-test-year 2024
+#
+# A one-step sliding-window forecast for a row depends only on the
+# window_size rows before it, so every fold's forecasts are slices of one
+# forecast over the whole span.  That forecast is computed once (split
+# across max_workers, through the pipeline's forecast cache, so rows any
+# earlier run already forecast are reused) and the folds, which are then
+# just binning and simulation, run in parallel processes.  With warm or
+# filter refits the carried state differs slightly from forecasting each
+# fold on its own
+import argparse
+import os
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import methods.fc as fc
+import methods.sim as sim
+import methods.pipeline as pipeline
+
+
+DEFAULT_PARAMS = {
+    **pipeline.DEFAULT_PARAMS,
+    'target' : 'COPPER_OPEN_NOMINAL',
+    'first_train_year' : 2007,
+    'first_test_year' : 2013,
+    'last_test_year' : 2024,
+    'train_years' : None,  # None: expanding folds; n: rolling folds of n years
+    'num_agents' : 100,
+    'eval_learning' : False,  # keep learning during the test year
+    'eval_price_delta_suffix' : '_PROPDELTA',  # realized returns score the test year
+}
+
+
+# One fold per test year, with its train years.  Returns a list of dicts
+# with FOLD, TRAIN_START_YEAR, TRAIN_END_YEAR and TEST_YEAR
+def get_yearly_folds(
+        dates : pd.Series,
+        first_test_year : int,
+        last_test_year : int,
+        first_train_year : int = None,
+        train_years : int = None) -> list[dict]:
+    years = pd.to_datetime(dates).dt.year
+    if first_train_year is None:
+        first_train_year = int(years.min())
+    last_test_year = min(last_test_year, int(years.max()))
+
+    folds = []
+    for test_year in range(first_test_year, last_test_year + 1):
+        train_start_year = first_train_year
+        if train_years is not None:
+            train_start_year = max(first_train_year, test_year - train_years)
+        if train_start_year >= test_year:
+            raise ValueError('No train years before test year ' + str(test_year))
+        folds.append({
+            'FOLD' : len(folds),
+            'TRAIN_START_YEAR' : train_start_year,
+            'TRAIN_END_YEAR' : test_year - 1,
+            'TEST_YEAR' : test_year})
+    return folds
+
+
+# Forecast and eval columns for the target over first_train_year through
+# the last test year, in one pass
+def build_backtest_forecast(
+        features_path : str,
+        params : dict,
+        forecast_cache_dir : str,
+        max_workers : int = None) -> pd.DataFrame:
+    target = params['target']
+    df = pd.read_parquet(features_path, columns=['DATE', target])
+    df['DATE'] = pd.to_datetime(df['DATE'])
+    years = df['DATE'].dt.year
+    df = df[(years >= params['first_train_year']) & (years <= params['last_test_year'])]
+    df = df.sort_values('DATE').reset_index(drop=True)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return fc.cached_fc_columns(
+            df = df,
+            target_name = target,
+            pdq = tuple(params['pdq']),
+            window_size = params['window_size'],
+            refit_mode = params['refit_mode'],
+            engine = params['engine'],
+            cache_dir = forecast_cache_dir,
+            max_workers = max_workers)
+
+
+# Worker-side copy of the forecast, set once per process by the pool
+# initializer so fold tasks only carry the fold and parameters
+_backtest_data = None
+
+def _init_backtest_worker(data : pd.DataFrame):
+    global _backtest_data
+    _backtest_data = data
+
+
+# Bin on the train years, train a population of agents on them, then run
+# the agents greedily through the test year.  Agents train on the params'
+# price signal (price_delta_suffix, the predicted deltas by default) but the
+# test year's portfolio values grow on eval_price_delta_suffix, the realized
+# deltas, so TERMINAL_VALUE is what the agents would actually have made.
+# Returns the fold's metrics
+def run_fold(
+        fold : dict,
+        params : dict) -> dict:
+    start_time = time.perf_counter()
+    target = params['target']
+    pred_col = target + '_PROPDELTA_PRED'
+    price_delta_col = target + params['price_delta_suffix']
+    eval_price_delta_col = target + params['eval_price_delta_suffix']
+
+    df = _backtest_data
+    years = df['DATE'].dt.year
+    df = df[(years >= fold['TRAIN_START_YEAR']) & (years <= fold['TEST_YEAR'])]
+    df = df.dropna(subset=[target, target + '_PRED', pred_col, price_delta_col, eval_price_delta_col]).reset_index(drop=True)
+    is_test = (df['DATE'].dt.year == fold['TEST_YEAR']).to_numpy()
+    num_train_steps = int((~is_test).sum())
+    df['FOLD_PRICE_DELTA'] = np.where(is_test, df[eval_price_delta_col], df[price_delta_col])
+
+    # Breakpoints from the train years only, so nothing leaks from the test year
+    encoder = sim.StateEncoder([pred_col], params['num_bins']).fit(df[~is_test])
+    df[pred_col + '_BIN'] = encoder.transform(df)
+
+    population = sim.PortfolioPopulation(
+        data = df,
+        date_col = 'DATE',
+        price_delta_pred_bins_col = pred_col + '_BIN',
+        price_delta_col = 'FOLD_PRICE_DELTA',
+        num_agents = params['num_agents'],
+        learning_rate = params['learning_rate'],
+        explore_chance = params['explore_chance'],
+        rebalance_limit_steps = params['rebalance_limit_steps'],
+        asset_balance_steps = params['asset_balance_steps'],
+        random_seeds = sim.get_agent_seeds(params['master_seed'], list(range(params['num_agents']))),
+        num_pred_bins = encoder.get_num_states())
+    lookback = params['learning_lookback_steps']
+    while population.current_step + 1 < num_train_steps:
+        population.step(exploring=True, learning=True, learning_lookback_steps=lookback)
+    while population.step(exploring=False, learning=params['eval_learning'], learning_lookback_steps=lookback):
+        pass
+
+    # Test-year growth of each agent, scaled to the usual starting value
+    values = population.portfolio_value
+    terminal_values = 1000000 * values[:, -1] / values[:, num_train_steps-1]
+
+    test = df[is_test]
+    return {
+        **fold,
+        'TRAIN_ROWS' : num_train_steps,
+        'TEST_ROWS' : len(test),
+        'MAE' : test[target + '_ERRABS'].mean(),
+        'SIGN_PRODUCT' : test[target + '_DELTA_SIGN_PRODUCT'].mean(),
+        'TERMINAL_VALUE' : np.median(terminal_values),
+        'TERMINAL_VALUE_MEAN' : terminal_values.mean(),
+        'FOLD_SECONDS' : time.perf_counter() - start_time,
+    }
+
+
+# Run every fold; params overrides DEFAULT_PARAMS.  Returns one row of
+# metrics per fold, with the whole run's wall time in attrs['wall_seconds']
+def run_backtest(
+        params : dict = None,
+        cache_dir : str = 'data_cache/pipeline',
+        max_workers : int = None,
+        verbose : bool = False) -> pd.DataFrame:
+    params = {**DEFAULT_PARAMS, **(params or {})}
+    start_time = time.perf_counter()
+
+    features_path, _ = pipeline.run_feature_stages(params, cache_dir, verbose=verbose)
+    data = build_backtest_forecast(
+        features_path, params, os.path.join(cache_dir, 'forecast_arrays'), max_workers)
+    if verbose:
+        print('Forecast ready in ' + str(round(time.perf_counter() - start_time, 2)) + 's')
+
+    folds = get_yearly_folds(
+        data['DATE'],
+        params['first_test_year'],
+        params['last_test_year'],
+        params['first_train_year'],
+        params['train_years'])
+
+    if max_workers == 1:
+        _init_backtest_worker(data)
+        rows = [run_fold(fold, params) for fold in folds]
+    else:
+        with ProcessPoolExecutor(
+                max_workers = max_workers,
+                initializer = _init_backtest_worker,
+                initargs = (data,)) as executor:
+            futures = [executor.submit(run_fold, fold, params) for fold in folds]
+            rows = [future.result() for future in futures]
+
+    results = pd.DataFrame(rows)
+    results.attrs['wall_seconds'] = time.perf_counter() - start_time
+    if verbose:
+        print('Backtest finished in ' + str(round(results.attrs['wall_seconds'], 2)) + 's')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--target')
+    parser.add_argument('--first-train-year', type=int)
+    parser.add_argument('--first-test-year', type=int)
+    parser.add_argument('--last-test-year', type=int)
+    parser.add_argument('--train-years', type=int, help='rolling folds of this many years (default: expanding)')
+    parser.add_argument('--engine', choices=['sarimax', 'batched'])
+    parser.add_argument('--num-agents', type=int)
+    parser.add_argument('--cache-dir', default='data_cache/pipeline')
+    parser.add_argument('--max-workers', type=int)
+    parser.add_argument('--output', help='write the per-fold metrics to this CSV')
+    parser.add_argument('--quiet', action='store_true')
+    args = parser.parse_args()
+
+    params = {}
+    for key in ['target', 'first_train_year', 'first_test_year', 'last_test_year', 'train_years', 'engine', 'num_agents']:
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+
+    results = run_backtest(params, args.cache_dir, args.max_workers, not args.quiet)
+    print(results.drop(columns=['FOLD']).to_string(index=False))
+    if args.output:
+        results.to_csv(args.output, index=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import ibis
+import pandas as pd
+import os
+
+
+# One ibis/DuckDB backend shared by the whole process.  prep, vis, and the
+# notebooks all use it (it's also set as ibis' default backend, so memtables
+# and ibis.read_csv land in the same database).  Created on first use with
+# default settings unless configure() is called first
+_backend = None
+_settings = {}
+
+
+# (Re)create the shared backend.  database=':memory:' keeps everything in
+# RAM; a file path persists registered tables between sessions.  threads,
+# memory_limit (e.g. '8GB') and temp_directory (where DuckDB spills when
+# over memory_limit) are passed through to DuckDB; None leaves its default
+def configure(
+        database : str = ':memory:',
+        threads : int = None,
+        memory_limit : str = None,
+        temp_directory : str = None):
+    global _backend, _settings
+
+    settings = {
+        'threads' : threads,
+        'memory_limit' : memory_limit,
+        'temp_directory' : temp_directory}
+    settings = {key : value for key, value in settings.items() if value is not None}
+
+    if database != ':memory:':
+        os.makedirs(os.path.dirname(os.path.abspath(database)), exist_ok=True)
+    if temp_directory is not None:
+        os.makedirs(temp_directory, exist_ok=True)
+
+    if _backend is not None:
+        _backend.disconnect()
+    _backend = ibis.duckdb.connect(database=database, **settings)
+    _settings = {'database' : database, **settings}
+    ibis.set_backend(_backend)
+    return _backend
+
+
+def get_backend():
+    if _backend is None:
+        configure()
+    return _backend
+
+
+def get_settings() -> dict:
+    get_backend()
+    return dict(_settings)
+
+
+def close():
+    global _backend, _settings
+    if _backend is not None:
+        _backend.disconnect()
+    _backend = None
+    _settings = {}
+
+
+# Materialize an intermediate result (merged data, forecasts, ...) as a
+# named table so later stages can reuse it.  Tables live as long as the
+# database: for the session in memory, across sessions when file-backed
+def register_table(
+        name : str,
+        table : ibis.Table | pd.DataFrame,
+        overwrite : bool = True) -> ibis.Table:
+    backend = get_backend()
+    backend.create_table(name, table, overwrite=overwrite)
+    return backend.table(name)
+
+
+def has_table(name : str) -> bool:
+    return name in get_backend().list_tables()
+
+
+def get_table(name : str) -> ibis.Table:
+    return get_backend().table(name)
+
+
+def drop_table(name : str):
+    get_backend().drop_table(name, force=True)
+
+
+def list_tables() -> list[str]:
+    return get_backend().list_tables()
+
+
+# Return the named table if it's already registered, otherwise build it
+# with build_table() and register the result
+def get_or_register_table(
+        name : str,
+        build_table) -> ibis.Table:
+    if has_table(name):
+        return get_table(name)
+    return register_table(name, build_table())
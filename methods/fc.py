@@ -1,31 +1,463 @@
 import pandas as pd
 import numpy as np
+import hashlib
+import inspect
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from skforecast.sarimax import Sarimax
+from methods import instrument
+
+
+# Fit a model on the window before each prediction step and predict one step ahead.
+# y holds the target values from (first pred step - window_size) onward.
+#
+# refit_mode controls how much optimizer work each step does:
+#   'full'   - fit every window from scratch
+#   'warm'   - fit every window, starting from the previous window's parameters
+#   'filter' - keep the parameters and slide the Kalman filter onto each new
+#              window, forecasting from it with no optimizer call; refit
+#              (warm-started) every refit_every steps, or sooner when the
+#              window's log-likelihood per observation under the kept
+#              parameters falls more than refit_tolerance below that of the
+#              window they were fit on
+# Warm and filter state starts fresh at each chunk, so their output depends on
+# chunk_size (but not on max_workers).  check_refit_agreement measures how far
+# a mode's forecasts sit from full refits
+def get_sliding_window_arima_chunk(
+    y : np.ndarray,
+    num_pred_steps : int,
+    pdq : tuple = (1,1,1),
+    window_size : int = 12,
+    refit_mode : str = 'full',
+    refit_every : int = 20,
+    refit_tolerance : float = 0.1,) -> np.ndarray:
+
+    if refit_mode not in ['full', 'warm', 'filter']:
+        raise ValueError("refit_mode must be 'full', 'warm' or 'filter', got " + str(refit_mode))
+
+    preds = np.full(num_pred_steps, np.nan)
+    state = None
+    for i in range(num_pred_steps):
+        with instrument.span('fc.fit_arima_window', refit_mode=refit_mode):
+            preds[i], state = fit_arima_window(
+                y[i:i+window_size], pdq, state, refit_mode, refit_every, refit_tolerance)
+
+    return preds
+
+
+# Fit (or update) the model on one window and predict one step ahead.
+# state carries (model, params, steps since refit, mean log-likelihood of the
+# window they were fit on) between consecutive windows; pass None for the
+# first window.  Returns (prediction, state)
+def fit_arima_window(
+    window : np.ndarray,
+    pdq : tuple = (1,1,1),
+    state : tuple = None,
+    refit_mode : str = 'full',
+    refit_every : int = 20,
+    refit_tolerance : float = 0.1,) -> tuple[float, tuple]:
+
+    window = pd.Series(window)
+    if state is None:
+        model, params, steps_since_refit, fit_llf = Sarimax(order = pdq), None, 0, None
+    else:
+        model, params, steps_since_refit, fit_llf = state
+
+    if params is None or refit_mode == 'full':
+        # Fit the model on the most recent window
+        model.fit(y = window)
+        steps_since_refit = 0
+        fit_llf = get_mean_llf(model)
+
+    elif refit_mode == 'warm':
+        model = Sarimax(order = pdq, start_params = params)
+        model.fit(y = window)
+        fit_llf = get_mean_llf(model)
+
+    else:
+        # Slide the filter onto the new window under the kept parameters.  If
+        # the window fits them about as well as the one they were fit on,
+        # forecast from the filter; otherwise they've drifted, so refit
+        pred, mean_llf = filter_arima_window(model, params, window)
+        steps_since_refit = steps_since_refit + 1
+        if fit_llf - mean_llf <= refit_tolerance and steps_since_refit < refit_every:
+            return pred, (model, params, steps_since_refit, fit_llf)
+
+        model = Sarimax(order = pdq, start_params = params)
+        model.fit(y = window)
+        steps_since_refit = 0
+        fit_llf = get_mean_llf(model)
+
+    params = np.asarray(model.sarimax_res.params)
+
+    # Predict the next timestep
+    pred = model.predict(steps=1).iloc[0, 0]
+    return pred, (model, params, steps_since_refit, fit_llf)
+
+
+# Mean log-likelihood per observation of a fitted model's window, after the
+# diffuse start-up observations
+def get_mean_llf(model : Sarimax) -> float:
+    res = model.sarimax_res
+    return np.mean(res.llf_obs[res.loglikelihood_burn:])
+
+
+# One-step forecast and mean log-likelihood per observation of window under
+# params, from the Kalman filter alone: no optimizer, smoother, or results
+# wrapper, which is most of the cost of Sarimax.apply + predict.  Returns
+# (prediction, mean log-likelihood)
+def filter_arima_window(
+        model : Sarimax,
+        params : np.ndarray,
+        window : pd.Series) -> tuple[float, float]:
+    filtered = model.sarimax_res.model.clone(window.to_numpy()).filter(params, return_ssm=True)
+    pred = filtered.design[0, :, 0] @ filtered.predicted_state[:, -1] + filtered.obs_intercept[0, 0]
+    return pred, np.mean(filtered.llf_obs[filtered.loglikelihood_burn:])
+
+
+# Solve many small least-squares problems at once: X is (batch, rows, k),
+# z is (batch, rows).  A tiny ridge keeps near-singular windows solvable
+def batched_least_squares(
+        X : np.ndarray,
+        z : np.ndarray,
+        ridge : float = 1e-8) -> np.ndarray:
+    XtX = np.einsum('bri,brj->bij', X, X)
+    Xtz = np.einsum('bri,br->bi', X, z)
+    XtX = XtX + ridge * np.eye(X.shape[2])[None, :, :]
+    return np.linalg.solve(XtX, Xtz[:, :, None])[:, :, 0]
+
+
+# Columns of lagged values, lags 1..num_lags, for rows first_row onward
+def get_lag_matrix(
+        x : np.ndarray,
+        num_lags : int,
+        first_row : int) -> np.ndarray:
+    return np.stack([x[:, first_row-lag:x.shape[1]-lag] for lag in range(1, num_lags+1)], axis=2)
+
+
+# Vectorized stand-in for refitting Sarimax on every window.  All windows are
+# a strided view of y, differenced in bulk, and every window's ARMA(p, q) is
+# estimated in one batched Hannan-Rissanen pass:
+#   1. a long AR fit gives residuals that stand in for the MA innovations
+#   2. the differenced values are regressed on their own lags and lagged residuals
+# The one-step forecast of the differenced series is then integrated back up.
+# Like Sarimax(order=pdq) there is no trend term.  Coefficients are clipped to
+# +/- coef_bound, which for p, q <= 1 keeps each window stationary and
+# invertible the way Sarimax's enforce_* options do
+def get_batched_arima_values(
+    y : np.ndarray,
+    pdq : tuple = (1,1,1),
+    window_size : int = 12,
+    start_step : int = None,
+    long_ar_order : int = None,
+    coef_bound : float = 0.99,) -> np.ndarray:
+
+    p, d, q = pdq
+    if start_step is None:
+        start_step = window_size
+    start_step = max(start_step, window_size)
+
+    preds = np.full(len(y), np.nan)
+    if start_step >= len(y):
+        return preds
+
+    # Window k covers y[k:k+window_size] and predicts y[k+window_size]
+    windows = np.lib.stride_tricks.sliding_window_view(y, window_size)[start_step-window_size:len(y)-window_size]
+    z = np.diff(windows, n=d, axis=1)
+
+    # Last value at each differencing level, for integrating the forecast back
+    level_lasts = sum(np.diff(windows, n=j, axis=1)[:, -1] for j in range(d))
+
+    if q > 0:
+        # Long AR order: enough lags to soak up the MA part without
+        # running out of rows in a short window
+        if long_ar_order is None:
+            long_ar_order = max(p + q, min(2 * (p + q), (z.shape[1] - 1) // 3))
+        long_ar_coefs = batched_least_squares(
+            get_lag_matrix(z, long_ar_order, long_ar_order),
+            z[:, long_ar_order:])
+        resid = np.zeros_like(z)
+        resid[:, long_ar_order:] = z[:, long_ar_order:] - np.einsum(
+            'bri,bi->br', get_lag_matrix(z, long_ar_order, long_ar_order), long_ar_coefs)
+        first_row = long_ar_order + q
+    else:
+        resid = None
+        first_row = p
+
+    if p + q == 0:
+        z_pred = np.zeros(len(windows))
+    else:
+        # Regress on lags of the series and of the residuals, then apply the
+        # coefficients to the most recent values to forecast one step ahead
+        design = []
+        latest = []
+        if p > 0:
+            design.append(get_lag_matrix(z, p, first_row))
+            latest.append(z[:, ::-1][:, :p])
+        if q > 0:
+            design.append(get_lag_matrix(resid, q, first_row))
+            latest.append(resid[:, ::-1][:, :q])
+        coefs = batched_least_squares(np.concatenate(design, axis=2), z[:, first_row:])
+        coefs = np.clip(coefs, -coef_bound, coef_bound)
+        z_pred = np.einsum('bi,bi->b', np.concatenate(latest, axis=1), coefs)
+
+    preds[start_step:] = level_lasts + z_pred
+    return preds
+
+
+# One-step-ahead sliding-window predictions for every row from start_step
+# (default: the first row with a full window) onward; earlier rows are NaN
+def get_sliding_window_arima_values(
+    y : np.ndarray,
+    pdq : tuple = (1,1,1),
+    window_size : int = 12,
+    start_step : int = None,
+    refit_mode : str = 'full',
+    refit_every : int = 20,
+    refit_tolerance : float = 0.1,
+    max_workers : int = 1,
+    chunk_size : int = 100,
+    progress_callback = None,
+    engine : str = 'sarimax',) -> np.ndarray:
+
+    if engine == 'batched':
+        with instrument.span('fc.batched_arima', rows=len(y)):
+            return get_batched_arima_values(y, pdq, window_size, start_step)
+    if engine != 'sarimax':
+        raise ValueError("engine must be 'sarimax' or 'batched', got " + str(engine))
+
+    if start_step is None:
+        start_step = window_size
+    start_step = max(start_step, window_size)
+
+    # Each window fit is independent, so split prediction steps into chunks,
+    # each shipped with just the values its windows need
+    chunk_starts = list(range(start_step, len(y), chunk_size))
+    chunks = [(y[start-window_size:min(start+chunk_size, len(y))], min(chunk_size, len(y)-start))
+              for start in chunk_starts]
+    refit_params = (refit_mode, refit_every, refit_tolerance)
+
+    preds = np.full(len(y), np.nan)
+    total_steps = max(len(y) - start_step, 0)
+    steps_done = 0
+    start_time = time.perf_counter()
+
+    def record(chunk_ind : int, chunk_preds : np.ndarray):
+        nonlocal steps_done
+        start = chunk_starts[chunk_ind]
+        preds[start:start+len(chunk_preds)] = chunk_preds
+        steps_done = steps_done + len(chunk_preds)
+        if progress_callback is not None:
+            progress_callback(steps_done, total_steps, steps_done / (time.perf_counter() - start_time))
+
+    if max_workers == 1:
+        for chunk_ind, (chunk_y, num_pred_steps) in enumerate(chunks):
+            record(chunk_ind, get_sliding_window_arima_chunk(chunk_y, num_pred_steps, pdq, window_size, *refit_params))
+    elif instrument.enabled:
+        # Workers record their own window fits and send them back
+        with ProcessPoolExecutor(max_workers = max_workers) as executor:
+            futures = {executor.submit(instrument.call_recorded, instrument.tracking_memory, get_sliding_window_arima_chunk,
+                                       chunk_y, num_pred_steps, pdq, window_size, *refit_params) : chunk_ind
+                       for chunk_ind, (chunk_y, num_pred_steps) in enumerate(chunks)}
+            for future in as_completed(futures):
+                chunk_preds, records = future.result()
+                instrument.add_records(records)
+                record(futures[future], chunk_preds)
+    else:
+        with ProcessPoolExecutor(max_workers = max_workers) as executor:
+            futures = {executor.submit(get_sliding_window_arima_chunk, chunk_y, num_pred_steps, pdq, window_size, *refit_params) : chunk_ind
+                       for chunk_ind, (chunk_y, num_pred_steps) in enumerate(chunks)}
+            for future in as_completed(futures):
+                record(futures[future], future.result())
+
+    return preds
+
 
 def sliding_window_arima_predictions(
     df : pd.DataFrame,
     target_name: str,
     pdq : tuple = (1,1,1),  # p autoregression lags, d differences, q moving average
-    window_size : int = 12,) -> pd.DataFrame:
+    window_size : int = 12,
+    refit_mode : str = 'full',  # 'full', 'warm' or 'filter' - see get_sliding_window_arima_chunk
+    refit_every : int = 20,
+    refit_tolerance : float = 0.1,
+    max_workers : int = 1,  # >1 (or None for all cores) fits windows in a process pool
+    chunk_size : int = 100,  # prediction steps per task
+    progress_callback = None,  # called as (steps done, total steps, steps per second)
+    engine : str = 'sarimax',) -> pd.DataFrame:  # 'batched' estimates all windows in one vectorized pass
 
     target_pred_name = target_name + '_PRED'
 
-    model = Sarimax(order = pdq)
+    # Add a column to the dataframe for the prediction, in row order
+    df[target_pred_name] = get_sliding_window_arima_values(
+        y = df[target_name].to_numpy(dtype=np.float64),
+        pdq = pdq,
+        window_size = window_size,
+        refit_mode = refit_mode,
+        refit_every = refit_every,
+        refit_tolerance = refit_tolerance,
+        max_workers = max_workers,
+        chunk_size = chunk_size,
+        progress_callback = progress_callback,
+        engine = engine)
 
-    # Add a column to the dataframe for the prediction
-    df[target_pred_name] = np.nan
+    return df
 
-    for pred_step in range(window_size, len(df)):
-        training_window_start_step = pred_step-window_size
 
-        # Fit the model on the most recent window
-        window_df = df[[target_name]].iloc[training_window_start_step:pred_step,:]
-        model.fit(y = window_df[target_name])
+# Forecasts from refit_mode against full refits on the same windows of y, run
+# as one chunk.  Differences are measured in typical one-step moves of each
+# window (the standard deviation of its first differences).  Returns summary stats; AGREES is whether the
+# mean difference is within agreement_tolerance
+def check_refit_agreement(
+    y : np.ndarray,
+    pdq : tuple = (1,1,1),
+    window_size : int = 12,
+    refit_mode : str = 'filter',
+    refit_every : int = 20,
+    refit_tolerance : float = 0.1,
+    agreement_tolerance : float = 0.5,) -> dict:
+
+    num_pred_steps = len(y) - window_size
+    full_preds = np.full(num_pred_steps, np.nan)
+    mode_preds = np.full(num_pred_steps, np.nan)
+    full_seconds = 0
+    mode_seconds = 0
+    num_refits = 0
+    full_state = None
+    mode_state = None
+    for i in range(num_pred_steps):
+        window = y[i:i+window_size]
+        start_time = time.perf_counter()
+        full_preds[i], full_state = fit_arima_window(window, pdq, full_state, 'full')
+        full_seconds = full_seconds + time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        mode_preds[i], mode_state = fit_arima_window(
+            window, pdq, mode_state, refit_mode, refit_every, refit_tolerance)
+        mode_seconds = mode_seconds + time.perf_counter() - start_time
+        num_refits = num_refits + (mode_state[2] == 0)
+
+    windows = np.lib.stride_tricks.sliding_window_view(y[:-1], window_size)
+    typical_moves = np.std(np.diff(windows, axis=1), axis=1)
+    diffs = np.abs(mode_preds - full_preds) / typical_moves
+    actuals = y[window_size:]
+    return {
+        'REFIT_MODE' : refit_mode,
+        'STEPS' : num_pred_steps,
+        'REFITS' : int(num_refits),
+        'MEAN_DIFF' : np.mean(diffs),
+        'MAX_DIFF' : np.max(diffs),
+        'FULL_MAE' : np.mean(np.abs(full_preds - actuals)),
+        'MODE_MAE' : np.mean(np.abs(mode_preds - actuals)),
+        'FULL_SECONDS' : full_seconds,
+        'MODE_SECONDS' : mode_seconds,
+        'AGREES' : bool(np.mean(diffs) <= agreement_tolerance),
+    }
+
+
+def get_array_hash(values : np.ndarray) -> str:
+    return hashlib.sha1(np.ascontiguousarray(values).tobytes()).hexdigest()
+
+
+# Drop least-recently-used files until the cache fits in max_cache_bytes.
+# Cache hits touch their file's mtime, so mtime doubles as the LRU clock
+def evict_lru_cache_files(
+        cache_dir : str,
+        max_cache_bytes : int):
+    cache_files = [os.path.join(root, name) 
+                   for root, _, names in os.walk(cache_dir) for name in names
+                   if name.endswith('.npy')]
+    cache_files = sorted(cache_files, key=os.path.getmtime)
+    total_bytes = sum(os.path.getsize(path) for path in cache_files)
+    for path in cache_files:
+        if total_bytes <= max_cache_bytes:
+            break
+        total_bytes = total_bytes - os.path.getsize(path)
+        os.remove(path)
 
-        # Predict and record a prediction for the next timestep
-        pred = model.predict(steps=1)
-        df.at[pred_step, target_pred_name] = pred.iloc[0]
 
+# sliding_window_arima_predictions + add_fc_eval_columns behind an on-disk cache.
+#
+# Predictions are stored as .npy under cache_dir/<settings hash>/<series hash>,
+# keyed by the target name, pdq, window_size and refit settings, and by a hash
+# of the target values.  If a cached series is a prefix of the current one
+# (e.g. new trading days were appended), only the missing tail is computed.
+# The eval columns are cheap vectorized pandas, so they're rebuilt from the
+# cached predictions rather than stored
+def cached_fc_columns(
+    df : pd.DataFrame,
+    target_name: str,
+    pdq : tuple = (1,1,1),
+    window_size : int = 12,
+    refit_mode : str = 'full',
+    refit_every : int = 20,
+    refit_tolerance : float = 0.1,
+    engine : str = 'sarimax',
+    add_eval_columns : bool = True,
+    cache_dir : str = 'data_cache/forecasts',
+    max_cache_bytes : int = 512 * 1024**2,
+    verbose : bool = False,
+    **forecast_kwargs) -> pd.DataFrame:  # passed on: max_workers, chunk_size, progress_callback
+
+    y = df[target_name].to_numpy(dtype=np.float64)
+
+    settings = [target_name, list(pdq), window_size, refit_mode, refit_every, refit_tolerance, engine]
+    if refit_mode != 'full' and engine == 'sarimax':
+        # Warm and filter state starts fresh at each chunk, and their output
+        # depends on how windows are updated between refits
+        settings.append(forecast_kwargs.get('chunk_size', 100))
+        settings.append(hashlib.sha1((inspect.getsource(fit_arima_window) 
+                                      + inspect.getsource(filter_arima_window)).encode('utf-8')).hexdigest())
+    settings_dir = os.path.join(cache_dir, hashlib.sha1(json.dumps(settings).encode('utf-8')).hexdigest()[:16])
+    os.makedirs(settings_dir, exist_ok=True)
+    series_path = os.path.join(settings_dir, get_array_hash(y) + '.npy')
+
+    if os.path.exists(series_path):
+        preds = np.load(series_path)
+        os.utime(series_path)
+        if verbose:
+            print('Forecast cache hit:  ' + series_path)
+    else:
+        # Reuse the longest cached series that this one extends
+        cached_preds = np.full(0, np.nan)
+        for name in os.listdir(settings_dir):
+            if not name.endswith('.npy'):
+                continue
+            path = os.path.join(settings_dir, name)
+            num_rows = np.load(path, mmap_mode='r').shape[0]
+            if (cached_preds.shape[0] < num_rows <= len(y)
+                    and get_array_hash(y[:num_rows]) + '.npy' == name):
+                cached_preds = np.load(path)
+                os.utime(path)
+
+        if verbose:
+            print('Forecast cache:  reusing ' + str(len(cached_preds)) + ' rows, computing ' 
+                  + str(len(y) - max(len(cached_preds), window_size)) + ' predictions')
+
+        preds = get_sliding_window_arima_values(
+            y = y,
+            pdq = pdq,
+            window_size = window_size,
+            start_step = len(cached_preds),
+            refit_mode = refit_mode,
+            refit_every = refit_every,
+            refit_tolerance = refit_tolerance,
+            engine = engine,
+            **forecast_kwargs)
+        preds[:len(cached_preds)] = cached_preds
+
+        # Write under a temporary name so readers never load a partial file
+        tmp_path = series_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, preds)
+        os.replace(tmp_path, series_path)
+        evict_lru_cache_files(cache_dir, max_cache_bytes)
+
+    df[target_name + '_PRED'] = preds
+    if add_eval_columns:
+        df = add_fc_eval_columns(df, target_name)
     return df
 
 
@@ -56,4 +488,71 @@ def add_fc_eval_columns(
     df[pred_feature+'_DELTA_ERRABS'] = np.abs(df[pred_feature+'_DELTA_ERRVAL'])
     df[pred_feature+'_DELTA_SIGN_PRODUCT'] = df[pred_feature+'_DELTA_SIGN'] * df[pred_feature+'_DELTA_SIGN_PRED']
 
-    return df
\ No newline at end of file
+    return df
+
+# One-step-ahead forecasts for a live series, one observation at a time.
+# Holds only the last window_size values (and the refit state), so each
+# update costs one window fit no matter how long the history is.  Matches
+# get_sliding_window_arima_values on the same series (for refit_mode='full'
+# or engine='batched'; warm/filter state carries across what would be chunk
+# boundaries in the batch version)
+class StreamingArimaForecaster:
+    def __init__(
+            self,
+            history : np.ndarray,
+            target_name : str,
+            pdq : tuple = (1,1,1),
+            window_size : int = 12,
+            refit_mode : str = 'full',
+            refit_every : int = 20,
+            refit_tolerance : float = 0.1,
+            engine : str = 'sarimax'):
+
+        if engine not in ['sarimax', 'batched']:
+            raise ValueError("engine must be 'sarimax' or 'batched', got " + str(engine))
+        if len(history) < window_size:
+            raise ValueError('Need at least ' + str(window_size) + ' values of history')
+
+        self.target_name = target_name
+        self.pdq = pdq
+        self.window_size = window_size
+        self.refit_params = (refit_mode, refit_every, refit_tolerance)
+        self.engine = engine
+
+        self.window = np.asarray(history[-window_size:], dtype=np.float64).copy()
+        self.state = None
+        self.next_pred = None
+
+    # Prediction for the next (not yet observed) value, computed once
+    def predict_next(self) -> float:
+        if self.next_pred is None:
+            if self.engine == 'batched':
+                y = np.append(self.window, np.nan)
+                self.next_pred = get_batched_arima_values(y, self.pdq, self.window_size)[-1]
+            else:
+                self.next_pred, self.state = fit_arima_window(self.window, self.pdq, self.state, *self.refit_params)
+        return self.next_pred
+
+    # Record the observed value and return its row of forecast and
+    # evaluation columns, named as add_fc_eval_columns names them
+    def update(self, value : float) -> dict:
+        pred = self.predict_next()
+        prev_value = self.window[-1]
+        self.window = np.append(self.window[1:], value)
+        self.next_pred = None
+
+        name = self.target_name
+        row = {name : value, name+'_PRED' : pred}
+        row[name+'_ERRVAL'] = value - pred
+        row[name+'_ERRRAT'] = row[name+'_ERRVAL'] / value
+        row[name+'_ERRABS'] = np.abs(row[name+'_ERRVAL'])
+        row[name+'_DELTA'] = value - prev_value
+        row[name+'_DELTA_PRED'] = pred - prev_value
+        row[name+'_PROPDELTA'] = (value - prev_value) / prev_value
+        row[name+'_PROPDELTA_PRED'] = (pred - prev_value) / prev_value
+        row[name+'_DELTA_SIGN'] = np.sign(row[name+'_DELTA'])
+        row[name+'_DELTA_SIGN_PRED'] = np.sign(row[name+'_DELTA_PRED'])
+        row[name+'_DELTA_ERRVAL'] = row[name+'_DELTA'] - row[name+'_DELTA_PRED']
+        row[name+'_DELTA_ERRABS'] = np.abs(row[name+'_DELTA_ERRVAL'])
+        row[name+'_DELTA_SIGN_PRODUCT'] = row[name+'_DELTA_SIGN'] * row[name+'_DELTA_SIGN_PRED']
+        return row
@@ -0,0 +1,199 @@
+import pandas as pd
+import contextlib
+import cProfile
+import json
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+import tracemalloc
+
+
+# Opt-in timing of the hot paths.  Code under measurement wraps each stage
+# in `with instrument.span('module.stage'):`; while disabled (the default)
+# span() hands back one shared no-op context, and the tightest loops check
+# `instrument.enabled` before doing anything at all.  Spans record wall
+# time, call counts, thread and process, and with track_memory=True the
+# peak traced Python allocation during the span (tracemalloc slows
+# allocation-heavy code noticeably, so it's off unless asked for)
+enabled = False
+tracking_memory = False
+_records = []
+_records_lock = threading.Lock()
+_local = threading.local()
+_null_span = contextlib.nullcontext()
+
+
+def enable(track_memory : bool = False):
+    global enabled, tracking_memory
+    tracking_memory = track_memory
+    if track_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    enabled = True
+
+
+def disable():
+    global enabled, tracking_memory
+    if tracking_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    enabled = False
+    tracking_memory = False
+
+
+def reset():
+    with _records_lock:
+        _records.clear()
+
+
+class Span:
+    __slots__ = ('name', 'args', 'start_ns')
+
+    def __init__(self, name : str, args : dict):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        if tracking_memory:
+            # tracemalloc keeps one peak per process, so each open span
+            # carries the highest peak seen before a nested span reset it
+            peaks = getattr(_local, 'peaks', None)
+            if peaks is None:
+                peaks = _local.peaks = []
+            if peaks:
+                peaks[-1] = max(peaks[-1], tracemalloc.get_traced_memory()[1])
+            peaks.append(0)
+            tracemalloc.reset_peak()
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        end_ns = time.perf_counter_ns()
+        peak = None
+        if tracking_memory:
+            peaks = _local.peaks
+            peak = max(peaks.pop(), tracemalloc.get_traced_memory()[1])
+            if peaks:
+                peaks[-1] = max(peaks[-1], peak)
+            tracemalloc.reset_peak()
+        with _records_lock:
+            _records.append((self.name, self.start_ns, end_ns, peak, os.getpid(), threading.get_ident(), self.args))
+        return False
+
+
+# Time a block as the named stage.  Keyword arguments are kept with the
+# record (and shown in trace viewers), so keep them small
+def span(name : str, **args):
+    if not enabled:
+        return _null_span
+    return Span(name, args)
+
+
+# Records made in another process, e.g. returned by call_recorded
+def add_records(records : list[tuple]):
+    with _records_lock:
+        _records.extend(records)
+
+
+# Run func in this (worker) process with instrumentation on and return
+# (result, records), so a process pool's spans can be passed back to the
+# parent and merged with add_records
+def call_recorded(
+        track_memory : bool,
+        func,
+        *args,
+        **kwargs) -> tuple:
+    enable(track_memory)
+    reset()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        with _records_lock:
+            records = list(_records)
+        reset()
+        disable()
+    return result, records
+
+
+def get_records() -> pd.DataFrame:
+    with _records_lock:
+        records = list(_records)
+    df = pd.DataFrame(records, columns=['NAME', 'START_NS', 'END_NS', 'PEAK_MEMORY_BYTES', 'PROCESS', 'THREAD', 'ARGS'])
+    df['SECONDS'] = (df['END_NS'] - df['START_NS']) / 1e9
+    return df.sort_values('START_NS', ignore_index=True)
+
+
+# One row per stage: calls, total/mean/max seconds and peak memory
+def summarize() -> pd.DataFrame:
+    df = get_records()
+    summary = df.groupby('NAME').agg(
+        CALLS = ('SECONDS', 'size'),
+        TOTAL_SECONDS = ('SECONDS', 'sum'),
+        MEAN_SECONDS = ('SECONDS', 'mean'),
+        MAX_SECONDS = ('SECONDS', 'max'),
+        PEAK_MEMORY_BYTES = ('PEAK_MEMORY_BYTES', 'max'))
+    return summary.sort_values('TOTAL_SECONDS', ascending=False)
+
+
+# Chrome trace event format: open in chrome://tracing or ui.perfetto.dev
+def get_chrome_trace() -> dict:
+    events = []
+    for row in get_records().itertuples(index=False):
+        args = {key : str(value) for key, value in row.ARGS.items()}
+        if pd.notna(row.PEAK_MEMORY_BYTES):
+            args['peak_memory_bytes'] = int(row.PEAK_MEMORY_BYTES)
+        events.append({
+            'name' : row.NAME,
+            'cat' : row.NAME.split('.')[0],
+            'ph' : 'X',
+            'ts' : row.START_NS / 1000,
+            'dur' : (row.END_NS - row.START_NS) / 1000,
+            'pid' : row.PROCESS,
+            'tid' : row.THREAD,
+            'args' : args})
+    return {'traceEvents' : events, 'displayTimeUnit' : 'ms'}
+
+
+def export_chrome_trace(path : str):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(get_chrome_trace(), f)
+
+
+# Profile everything run inside the block and write the profile to
+# output_path.  profiler='cprofile' uses the standard library's
+# deterministic profiler on this process (read with pstats or snakeviz);
+# profiler='py-spy' attaches the py-spy sampling profiler, which must be on
+# PATH, to this process and its pool workers and writes a speedscope file
+@contextlib.contextmanager
+def profile(
+        output_path : str,
+        profiler : str = 'cprofile',
+        rate : int = 100):
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+
+    if profiler == 'cprofile':
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            prof.dump_stats(output_path)
+
+    elif profiler == 'py-spy':
+        if shutil.which('py-spy') is None:
+            raise RuntimeError('py-spy not found on PATH; pip install py-spy or use profiler="cprofile"')
+        sampler = subprocess.Popen([
+            'py-spy', 'record', '--pid', str(os.getpid()), '--subprocesses',
+            '--rate', str(rate), '--format', 'speedscope', '--output', output_path])
+        time.sleep(1)  # Give it time to attach before the interesting part
+        try:
+            yield
+        finally:
+            sampler.send_signal(signal.SIGINT)
+            sampler.wait()
+
+    else:
+        raise ValueError("profiler must be 'cprofile' or 'py-spy', got " + str(profiler))
@@ -0,0 +1,529 @@
+# Headless version of the three notebooks: ingest -> features -> forecast ->
+# bin -> simulate.  Every stage writes its output under cache_dir named by a
+# fingerprint of its parameters, its inputs' fingerprints, and the source of
+# the methods module it runs, so a rerun only recomputes stages whose inputs
+# changed.  Forecasts (and their bins and simulations) for different targets
+# are independent and run in parallel.  From the repo root:
+#   python -m methods.pipeline --targets COPPER_OPEN_NOMINAL --num-agents 500
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import ibis
+import pandas as pd
+import methods.prep as prep
+import methods.fc as fc
+import methods.sim as sim
+from methods import instrument
+
+
+DEFAULT_PARAMS = {
+    # ingest
+    'data_path' : 'data_staged/',
+
+    # features
+    'start_date' : '2006-01-01',
+    'end_date' : '2024-10-31',
+    'macro_lag_steps' : 90,
+    'lead_targets' : [
+        'COPPER_OPEN_REAL',
+        'COPPER_PRICE_REAL',
+        'COPPER_OPEN_NOMINAL',
+        'COPPER_PRICE_NOMINAL'],
+    'lead_steps' : [1, 5],
+
+    # forecast, over the model development years
+    'targets' : ['COPPER_OPEN_NOMINAL'],
+    'dev_years' : [2007, 2019],
+    'pdq' : [1, 2, 1],
+    'window_size' : 12,
+    'refit_mode' : 'full',
+    'engine' : 'sarimax',
+
+    # bin
+    'bin_start_year' : 2008,
+    'num_bins' : 11,
+
+    # simulate
+    'price_delta_suffix' : '_PROPDELTA_PRED',
+    'num_agents' : 500,
+    'master_seed' : 42,
+    'learning_rate' : 1,
+    'explore_chance' : 0.3,
+    'rebalance_limit_steps' : 2,
+    'asset_balance_steps' : [x/10.0 for x in range(11)],
+    'learning_lookback_steps' : 5,
+}
+
+
+def get_file_hash(path : str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+# Stage code is this file plus the methods module the stage runs
+def get_stage_fingerprint(
+        stage_name : str,
+        params : dict,
+        upstream : list[str],
+        module = None) -> str:
+    code = [get_file_hash(__file__)]
+    if module is not None:
+        code.append(get_file_hash(module.__file__))
+    key = {
+        'stage' : stage_name,
+        'params' : params,
+        'upstream' : upstream,
+        'code' : code}
+    return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+
+# Return the cached output of a stage, or build it and cache it.  Output is
+# written to a temp file and renamed so an interrupted run never leaves a
+# partial file under a valid fingerprint
+def run_stage(
+        stage_name : str,
+        fingerprint : str,
+        build_stage,
+        cache_dir : str,
+        force : bool = False,
+        verbose : bool = False) -> str:
+    stage_dir = os.path.join(cache_dir, stage_name)
+    os.makedirs(stage_dir, exist_ok=True)
+    output_path = os.path.join(stage_dir, fingerprint + '.parquet')
+
+    if os.path.exists(output_path) and not force:
+        if verbose:
+            print(stage_name + ': cached (' + fingerprint + ')')
+        return output_path
+
+    start = time.perf_counter()
+    with instrument.span('pipeline.' + stage_name, fingerprint=fingerprint):
+        df = build_stage()
+        tmp_path = output_path + '.tmp'
+        df.to_parquet(tmp_path)
+        os.replace(tmp_path, output_path)
+    if verbose:
+        print(stage_name + ': built ' + str(df.shape) + ' in '
+              + str(round(time.perf_counter() - start, 2)) + 's (' + fingerprint + ')')
+    return output_path
+
+
+# All sources merged onto one row per calendar day, before forward fill
+def build_merged_daily_table(
+        ingest_dir : str,
+        params : dict) -> ibis.Table:
+    fred_datasets = prep.load_ingested_tables(prep.FRED_DATASET_NAMES, ingest_dir)
+    inv_datasets = prep.load_ingested_tables(prep.INV_DATASET_NAMES, ingest_dir)
+
+    # Keep some of 2006 to support forward fill
+    for name, table in fred_datasets.items():
+        fred_datasets[name] = table.filter(table.DATE.year() > 2005)
+
+    inv_data = prep.merge_tables(inv_datasets, join_type='outer', method='spine')
+    fred_data = prep.merge_tables(fred_datasets, join_type='outer', method='spine')
+    fred_data = fred_data.filter(fred_data.DATE.year() > 2006)
+
+    daterange = pd.DataFrame(
+        pd.date_range(params['start_date'], params['end_date']).date,
+        columns=['DATE'])
+    return prep.merge_tables(
+        {'inv' : inv_data, 'fred' : fred_data, 'dates' : daterange},
+        join_type='outer',
+        method='spine')
+
+
+# Merged daily table with forward fill and standard features, filtered to
+# copper trading days, with lead targets.  Replaces data_forecasting/data.csv
+def build_features(
+        ingest_dir : str,
+        params : dict) -> pd.DataFrame:
+    data = build_merged_daily_table(ingest_dir, params)
+    data = prep.impute_forward_fill_numerics(data, sort_by='DATE')
+    data = prep.compile_feature_spec(data, prep.get_standard_feature_spec(params['macro_lag_steps']))
+
+    # Leads count trading days, so they're taken after the filter
+    data = data.filter(data.COPPER_TRADING_DAY)
+    lead_spec = {
+        'leads' : {col : params['lead_steps'] for col in params['lead_targets']},
+        'renames' : {
+            col + '_LEAD' + str(step) : col + '_LEAD' + str(step) + '_TARGET'
+            for col in params['lead_targets'] for step in params['lead_steps']}}
+    data = prep.compile_feature_spec(data, lead_spec)
+
+    with instrument.span('pipeline.to_pandas', stage='features'):
+        return data.to_pandas()
+
+
+# Sliding-window ARIMA forecast of one target over the development years,
+# with evaluation columns.  Replaces data_decisioning/dev_data.csv
+def build_forecast(
+        features_path : str,
+        target : str,
+        params : dict,
+        forecast_cache_dir : str) -> pd.DataFrame:
+    df = pd.read_parquet(features_path)
+    df['DATE'] = pd.to_datetime(df['DATE'])
+    first_year, last_year = params['dev_years']
+    df = df[(df['DATE'].dt.year >= first_year) & (df['DATE'].dt.year <= last_year)]
+    df = df.sort_values('DATE').reset_index(drop=True)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return fc.cached_fc_columns(
+            df = df,
+            target_name = target,
+            pdq = tuple(params['pdq']),
+            window_size = params['window_size'],
+            refit_mode = params['refit_mode'],
+            engine = params['engine'],
+            cache_dir = forecast_cache_dir)
+
+
+# Quantile bins of the predicted proportional delta, as in 03_decisioning.
+# The fitted encoder is saved to encoder_path for encoding later days
+def build_bins(
+        forecast_path : str,
+        target : str,
+        params : dict,
+        encoder_path : str) -> pd.DataFrame:
+    pred_col = target + '_PROPDELTA_PRED'
+    columns = ['DATE', target, target + '_PRED', target + '_PROPDELTA', pred_col]
+
+    df = pd.read_parquet(forecast_path, columns=columns)
+    df = df[df['DATE'].dt.year >= params['bin_start_year']].dropna().reset_index(drop=True)
+
+    encoder = sim.StateEncoder([pred_col], params['num_bins']).fit(df)
+    df[pred_col + '_BIN'] = encoder.transform(df)
+    encoder.save(encoder_path)
+    return df
+
+
+def get_encoder_path(bins_path : str) -> str:
+    return bins_path[:-len('.parquet')] + '.encoder.json'
+
+
+def build_simulation(
+        bins_path : str,
+        target : str,
+        params : dict,
+        max_workers : int = None) -> pd.DataFrame:
+    df = pd.read_parquet(bins_path)
+    results = sim.run_experiment(
+        data = df,
+        date_col = 'DATE',
+        price_delta_pred_bins_col = target + '_PROPDELTA_PRED_BIN',
+        price_delta_col = target + params['price_delta_suffix'],
+        num_agents = params['num_agents'],
+        master_seed = params['master_seed'],
+        learning_rate = params['learning_rate'],
+        explore_chance = params['explore_chance'],
+        rebalance_limit_steps = params['rebalance_limit_steps'],
+        asset_balance_steps = params['asset_balance_steps'],
+        learning_lookback_steps = params['learning_lookback_steps'],
+        max_workers = max_workers)
+    return results.drop(columns=['PORTFOLIO_VALUE_PATH'])
+
+
+# Several targets' bins side by side, on the dates every one of them has,
+# for sim.MultiAssetAgent.  outputs is run_pipeline's return value
+def load_multi_asset_data(
+        outputs : dict,
+        targets : list[str]) -> pd.DataFrame:
+    data = None
+    for target in targets:
+        bins = pd.read_parquet(outputs[target]['bin'])
+        bins = bins[['DATE'] + [col for col in bins.columns if col.startswith(target + '_PROPDELTA')]]
+        data = bins if data is None else data.merge(bins, on='DATE', how='inner')
+    return data.sort_values('DATE').reset_index(drop=True)
+
+
+# forecast -> bin -> simulate for one target, stopping after last_stage
+# ('bin' skips the simulation).  Runs in a worker process when there are
+# several targets
+def run_target_stages(
+        target : str,
+        features_path : str,
+        features_fingerprint : str,
+        params : dict,
+        cache_dir : str,
+        force : list[str],
+        sim_workers : int = None,
+        verbose : bool = False,
+        last_stage : str = 'simulate') -> dict:
+    forecast_params = {key : params[key] for key in ['dev_years', 'pdq', 'window_size', 'refit_mode', 'engine']}
+    forecast_fingerprint = get_stage_fingerprint(
+        'forecast', {'target' : target, **forecast_params}, [features_fingerprint], fc)
+    forecast_path = run_stage(
+        'forecast',
+        forecast_fingerprint,
+        lambda: build_forecast(features_path, target, params, os.path.join(cache_dir, 'forecast_arrays')),
+        cache_dir, 'forecast' in force, verbose)
+
+    bin_params = {key : params[key] for key in ['bin_start_year', 'num_bins']}
+    bins_fingerprint = get_stage_fingerprint(
+        'bin', {'target' : target, **bin_params}, [forecast_fingerprint], sim)
+    encoder_path = os.path.join(cache_dir, 'bin', bins_fingerprint + '.encoder.json')
+    bins_path = run_stage(
+        'bin',
+        bins_fingerprint,
+        lambda: build_bins(forecast_path, target, params, encoder_path),
+        cache_dir, 'bin' in force or not os.path.exists(encoder_path), verbose)
+    if last_stage == 'bin':
+        return {'forecast' : forecast_path, 'bin' : bins_path}
+
+    sim_params = {key : params[key] for key in [
+        'price_delta_suffix', 'num_agents', 'master_seed', 'learning_rate', 'explore_chance',
+        'rebalance_limit_steps', 'asset_balance_steps', 'learning_lookback_steps']}
+    sim_fingerprint = get_stage_fingerprint(
+        'simulate', {'target' : target, **sim_params}, [bins_fingerprint], sim)
+    sim_path = run_stage(
+        'simulate',
+        sim_fingerprint,
+        lambda: build_simulation(bins_path, target, params, sim_workers),
+        cache_dir, 'simulate' in force, verbose)
+
+    return {'forecast' : forecast_path, 'bin' : bins_path, 'simulate' : sim_path}
+
+
+# ingest -> features, shared by every target.  params is complete (defaults
+# already applied).  Returns (features path, features fingerprint)
+def run_feature_stages(
+        params : dict,
+        cache_dir : str = 'data_cache/pipeline',
+        force : list[str] = [],
+        verbose : bool = False) -> tuple[str, str]:
+
+    # Ingest is incremental on its own: only changed CSVs are re-parsed
+    ingest_dir = os.path.join(cache_dir, 'ingest')
+    with instrument.span('pipeline.ingest'):
+        manifest = prep.ingest_staged_csvs(params['data_path'], ingest_dir, verbose=verbose)
+    ingest_fingerprint = get_stage_fingerprint(
+        'ingest', {name : entry['source_sha1'] for name, entry in manifest.items()}, [], prep)
+
+    feature_params = {key : params[key] for key in [
+        'start_date', 'end_date', 'macro_lag_steps', 'lead_targets', 'lead_steps']}
+    features_fingerprint = get_stage_fingerprint('features', feature_params, [ingest_fingerprint], prep)
+    features_path = run_stage(
+        'features',
+        features_fingerprint,
+        lambda: build_features(ingest_dir, params),
+        cache_dir, 'features' in force, verbose)
+    return features_path, features_fingerprint
+
+
+# Run the whole pipeline.  params overrides DEFAULT_PARAMS; force lists
+# stages to rebuild even if cached.  Returns the output path of every stage
+def run_pipeline(
+        params : dict = None,
+        cache_dir : str = 'data_cache/pipeline',
+        force : list[str] = [],
+        max_workers : int = None,
+        verbose : bool = False) -> dict:
+    params = {**DEFAULT_PARAMS, **(params or {})}
+    start = time.perf_counter()
+
+    features_path, features_fingerprint = run_feature_stages(params, cache_dir, force, verbose)
+    outputs = {'ingest' : os.path.join(cache_dir, 'ingest', 'manifest.json'), 'features' : features_path}
+    targets = params['targets']
+    stage_args = (features_path, features_fingerprint, params, cache_dir, force)
+    if len(targets) == 1 or max_workers == 1:
+        for target in targets:
+            outputs[target] = run_target_stages(target, *stage_args, max_workers, verbose)
+    else:
+        # One process per target; each simulation then runs in its process
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            if instrument.enabled:
+                futures = {target : executor.submit(instrument.call_recorded, instrument.tracking_memory,
+                                                    run_target_stages, target, *stage_args, 1, verbose)
+                           for target in targets}
+                for target, future in futures.items():
+                    outputs[target], records = future.result()
+                    instrument.add_records(records)
+            else:
+                futures = {target : executor.submit(run_target_stages, target, *stage_args, 1, verbose)
+                           for target in targets}
+                for target, future in futures.items():
+                    outputs[target] = future.result()
+
+    if verbose:
+        print('Pipeline finished in ' + str(round(time.perf_counter() - start, 2)) + 's')
+    return outputs
+
+
+# Streaming daily mode: take one new day of data through forward fill,
+# features, forecast, binning, and one agent step, touching only the state
+# each stage keeps (recent daily rows, the forecast window, the agent's
+# buffers), so the cost per day doesn't grow with the history
+class DailyUpdater:
+    def __init__(
+            self,
+            feature_state : prep.StreamingFeatureState,
+            forecaster : fc.StreamingArimaForecaster,
+            encoder : sim.StateEncoder,
+            agent : sim.PortfolioAgent,
+            price_delta_suffix : str = '_PROPDELTA_PRED',
+            trading_day_col : str = 'COPPER_TRADING_DAY',
+            exploring : bool = True,
+            learning : bool = True,
+            learning_lookback_steps : int = 5):
+        
+        self.feature_state = feature_state
+        self.forecaster = forecaster
+        self.encoder = encoder
+        self.agent = agent
+        self.price_delta_suffix = price_delta_suffix
+        self.trading_day_col = trading_day_col
+        self.step_params = {
+            'exploring' : exploring,
+            'learning' : learning,
+            'learning_lookback_steps' : learning_lookback_steps}
+
+    # values holds everything observed for date (the day's bar, macro values
+    # dated that day).  Non-trading days only advance the features.  Returns
+    # the day's features, plus forecast, bin, and the agent's new balance and
+    # portfolio value on trading days
+    def update(
+            self,
+            date,
+            values : dict) -> dict:
+        row = self.feature_state.update(date, values)
+        if not row.get(self.trading_day_col):
+            return row
+
+        target = self.forecaster.target_name
+        row.update(self.forecaster.update(row[target]))
+        pred_bin = self.encoder.transform_row(row)
+        row[target + '_PROPDELTA_PRED_BIN'] = pred_bin
+
+        agent = self.agent
+        agent.append_data(pd.DataFrame({
+            agent.date_col : [pd.Timestamp(row['DATE'])],
+            agent.price_delta_pred_bins_col : [pred_bin],
+            agent.price_delta_col : [row[target + self.price_delta_suffix]]}))
+        agent.step(**self.step_params)
+        row['ASSET_BALANCE'] = agent.asset_balance_values[agent.asset_balance_at_open_ind[agent.current_step]]
+        row['PORTFOLIO_VALUE'] = agent.portfolio_value[agent.current_step]
+        return row
+
+
+# Build a DailyUpdater for one target from the pipeline's cached stages.
+# The agent trains on the binned development years (as the simulate stage
+# does, one agent seeded with master_seed); then every later day in the
+# data is replayed through update(), so the updater ends caught up to the
+# last staged day and ready for new ones.  Returns (updater, replayed rows)
+def make_daily_updater(
+        params : dict = None,
+        target : str = None,
+        cache_dir : str = 'data_cache/pipeline',
+        verbose : bool = False) -> tuple[DailyUpdater, pd.DataFrame]:
+    params = {**DEFAULT_PARAMS, **(params or {})}
+    target = target or params['targets'][0]
+    outputs = run_pipeline({**params, 'targets' : [target]}, cache_dir, verbose=verbose)
+
+    bins = pd.read_parquet(outputs[target]['bin'])
+    pred_col = target + '_PROPDELTA_PRED'
+    encoder = sim.load_state_encoder(get_encoder_path(outputs[target]['bin']))
+
+    agent = sim.PortfolioAgent(
+        data = bins,
+        date_col = 'DATE',
+        price_delta_pred_bins_col = pred_col + '_BIN',
+        price_delta_col = target + params['price_delta_suffix'],
+        learning_rate = params['learning_rate'],
+        explore_chance = params['explore_chance'],
+        rebalance_limit_steps = params['rebalance_limit_steps'],
+        asset_balance_steps = params['asset_balance_steps'],
+        random_seed = params['master_seed'],
+        num_pred_bins = encoder.get_num_states())
+    while agent.step(True, True, params['learning_lookback_steps']):
+        pass
+
+    # Daily state as of the last development day, and the raw days after it
+    cutoff = bins['DATE'].max().date()
+    daily = build_merged_daily_table(os.path.join(cache_dir, 'ingest'), params).to_pandas()
+    daily = daily.sort_values('DATE').reset_index(drop=True)
+    history = daily[daily['DATE'] <= cutoff]
+    filled = prep.impute_forward_fill_numerics(ibis.memtable(history)).to_pandas()
+    feature_state = prep.StreamingFeatureState(filled, prep.get_standard_feature_spec(params['macro_lag_steps']))
+
+    features = pd.read_parquet(outputs['features'])
+    target_history = features[features['DATE'] <= cutoff][target].to_numpy()
+    forecaster = fc.StreamingArimaForecaster(
+        target_history, 
+        target,
+        tuple(params['pdq']),
+        params['window_size'],
+        params['refit_mode'],
+        engine = params['engine'])
+
+    updater = DailyUpdater(
+        feature_state, 
+        forecaster, 
+        encoder, 
+        agent, 
+        params['price_delta_suffix'],
+        learning_lookback_steps = params['learning_lookback_steps'])
+
+    replayed = []
+    for raw_row in daily[daily['DATE'] > cutoff].to_dict('records'):
+        values = {col : value for col, value in raw_row.items() if col != 'DATE' and not pd.isna(value)}
+        replayed.append(updater.update(raw_row['DATE'], values))
+    if verbose:
+        print('Replayed ' + str(len(replayed)) + ' days after ' + str(cutoff))
+
+    return updater, pd.DataFrame(replayed)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', help='JSON file of parameters overriding the defaults')
+    parser.add_argument('--targets', nargs='+', help='columns to forecast and simulate')
+    parser.add_argument('--engine', choices=['sarimax', 'batched'])
+    parser.add_argument('--num-agents', type=int)
+    parser.add_argument('--cache-dir', default='data_cache/pipeline')
+    parser.add_argument('--force', nargs='*', default=[],
+                        choices=['features', 'forecast', 'bin', 'simulate'],
+                        help='stages to rebuild even if cached')
+    parser.add_argument('--max-workers', type=int)
+    parser.add_argument('--quiet', action='store_true')
+    parser.add_argument('--trace', help='write a Chrome trace of stage timings here')
+    parser.add_argument('--track-memory', action='store_true', help='record peak memory per stage in the trace')
+    parser.add_argument('--profile', help='write a profile of the whole run here')
+    parser.add_argument('--profiler', default='cprofile', choices=['cprofile', 'py-spy'])
+    args = parser.parse_args()
+
+    params = {}
+    if args.config:
+        with open(args.config) as f:
+            params = json.load(f)
+    if args.targets:
+        params['targets'] = args.targets
+    if args.engine:
+        params['engine'] = args.engine
+    if args.num_agents:
+        params['num_agents'] = args.num_agents
+
+    if args.trace:
+        instrument.enable(args.track_memory)
+    profiling = instrument.profile(args.profile, args.profiler) if args.profile else contextlib.nullcontext()
+    with profiling:
+        outputs = run_pipeline(params, args.cache_dir, args.force, args.max_workers, not args.quiet)
+    if args.trace:
+        instrument.export_chrome_trace(args.trace)
+        print(instrument.summarize().to_string())
+
+    # Summarize the simulations
+    for target in {**DEFAULT_PARAMS, **params}['targets']:
+        results = pd.read_parquet(outputs[target]['simulate'])
+        print(target + ':  median final portfolio value '
+              + str(round(results['FINAL_PORTFOLIO_VALUE'].median(), 4)) + ', mean '
+              + str(round(results['FINAL_PORTFOLIO_VALUE'].mean(), 4)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,261 @@
 import ibis
 import pandas as pd
 import numpy as np
-con = ibis.connect("duckdb://")
+import datetime
+import duckdb
+import hashlib
+import inspect
+import json
+import os
+import uuid
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from methods import db
+from methods import instrument
+
+# Make the shared backend ibis' default before any tables are read, so
+# memtables and ibis.read_csv tables all live in the same database
+db.get_backend()
+
+
+FRED_DATASET_NAMES = [
+    'CSENT',
+    'CPI',
+    'POP',
+    'WAGE',
+    'HOUSEPRICE',
+    'HOUSESTARTS',
+    'UNEMPLOYMENT',
+]
+
+INV_DATASET_NAMES = [
+    'COPPER', 
+    'CORN', 
+    'GOLD',
+    'LUMBER',
+    'NATGAS',
+    'OIL',
+    'R2000', 
+    'SOY',
+    'SP500',
+    'VIX'
+]
+
+TRADED_COMMODITIES = [
+    'COPPER'
+]
+
+
+# Staged file names aren't consistently cased (CPI.csv vs cpi.csv)
+def find_staged_file(
+        data_path : str,
+        dataset_name : str,
+        extension : str = '.csv') -> str:
+    target = (dataset_name + extension).lower()
+    for file_name in os.listdir(data_path):
+        if file_name.lower() == target:
+            return os.path.join(data_path, file_name)
+    raise FileNotFoundError('No ' + dataset_name + extension + ' in ' + data_path)
+
+
+def get_file_hash(path : str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+# FRED single-series CSV: DATE plus one value column, renamed to the dataset
+# name.  Missing values are '.', which become nulls
+def parse_fred_csv(
+        backend,
+        path : str,
+        dataset_name : str) -> ibis.Table:
+    table = backend.read_csv(path, dateformat='%m/%d/%Y')
+    table = table.rename({dataset_name : table.columns[1]})
+    table = table.mutate(DATE = table['DATE'].cast('date'))
+    table = table.rename('ALL_CAPS')
+    if table[dataset_name].type().is_string():
+        table = table.mutate(**{
+            dataset_name : table[dataset_name].replace(',','').try_cast('float64')})
+    return table
+
+
+# Investing.com CSV: drop volume/change, flag traded days, parse prices
+# with thousands separators, and prefix columns with the dataset name
+def parse_inv_csv(
+        backend,
+        path : str,
+        dataset_name : str,
+        traded : bool = False) -> ibis.Table:
+    table = backend.read_csv(path, dateformat='%m/%d/%Y')
+    table = table.drop('Vol.','Change %')
+    if traded:
+        table = table.mutate(TRADING_DAY = True)
+    table = table.rename('ALL_CAPS')
+
+    for col in ['PRICE', 'OPEN', 'HIGH', 'LOW']:
+        if table[col].type().is_string():
+            table = table.mutate(**{col : table[col].replace(',','').cast('float64')})
+
+    names_map = {
+        f"{dataset_name}_{col}" : col 
+            for col in table.columns
+            if col != 'DATE'}
+    return table.rename(names_map)
+
+
+# Parse one staged CSV into Parquet, each in its own DuckDB connection so
+# sources can be parsed concurrently
+def ingest_staged_file(
+        source_path : str,
+        parquet_path : str,
+        dataset_name : str,
+        source_kind : str,
+        traded : bool) -> int:
+    backend = ibis.duckdb.connect()
+    if source_kind == 'fred':
+        table = parse_fred_csv(backend, source_path, dataset_name)
+    else:
+        table = parse_inv_csv(backend, source_path, dataset_name, traded)
+    table = table.order_by('DATE')
+    table.to_parquet(parquet_path)
+    num_rows = int(table.count().execute())
+    backend.disconnect()
+    return num_rows
+
+
+# Hash of the code that turns one kind of staged CSV into Parquet, plus the
+# ibis and DuckDB versions that run it, so cached Parquet files are re-parsed
+# when the parsing changes and not only when the source data does
+def get_parser_hash(source_kind : str) -> str:
+    parser = parse_fred_csv if source_kind == 'fred' else parse_inv_csv
+    code = [inspect.getsource(parser), inspect.getsource(ingest_staged_file), 
+            ibis.__version__, duckdb.__version__]
+    return hashlib.sha1('\n'.join(code).encode('utf-8')).hexdigest()
+
+
+# Parse data_staged CSVs into typed Parquet files under cache_dir, with a
+# manifest.json of source and parser hashes and row counts.  Only sources
+# whose content, parser, or parse settings changed since the last run are
+# re-parsed.
+# Returns the manifest
+def ingest_staged_csvs(
+        data_path : str = 'data_staged/',
+        cache_dir : str = 'data_cache/ingest',
+        fred_dataset_names : list[str] = FRED_DATASET_NAMES,
+        inv_dataset_names : list[str] = INV_DATASET_NAMES,
+        traded_commodities : list[str] = TRADED_COMMODITIES,
+        max_workers : int = None,
+        verbose : bool = False) -> dict:
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest_path = os.path.join(cache_dir, 'manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    sources = [(name, 'fred') for name in fred_dataset_names] + [(name, 'inv') for name in inv_dataset_names]
+    stale = {}
+    for dataset_name, source_kind in sources:
+        source_path = find_staged_file(data_path, dataset_name)
+        entry = {
+            'source' : os.path.basename(source_path),
+            'source_sha1' : get_file_hash(source_path),
+            'kind' : source_kind,
+            'parser_sha1' : get_parser_hash(source_kind),
+            'traded' : dataset_name in traded_commodities,
+            'parquet' : dataset_name + '.parquet'}
+        
+        cached = manifest.get(dataset_name, {})
+        up_to_date = (
+            all(cached.get(key) == value for key, value in entry.items())
+            and os.path.exists(os.path.join(cache_dir, entry['parquet'])))
+        if up_to_date:
+            continue
+        stale[dataset_name] = (source_path, entry)
+
+    # Parse changed sources concurrently; DuckDB releases the GIL
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            dataset_name : executor.submit(
+                ingest_staged_file, 
+                source_path, 
+                os.path.join(cache_dir, entry['parquet']),
+                dataset_name,
+                entry['kind'],
+                entry['traded'])
+            for dataset_name, (source_path, entry) in stale.items()}
+        for dataset_name, future in futures.items():
+            entry = stale[dataset_name][1]
+            entry['rows'] = future.result()
+            manifest[dataset_name] = entry
+            if verbose:
+                print('Parsed ' + entry['source'] + ': ' + str(entry['rows']) + ' rows')
+
+    if verbose:
+        print(str(len(stale)) + ' of ' + str(len(sources)) + ' sources re-parsed')
+
+    # Write the manifest atomically so an interrupted run can't corrupt it
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+    return manifest
+
+
+# Load ingested Parquet files as tables in one DuckDB session (the shared
+# db backend by default).  Each dataset is read into its own table over a
+# separate cursor on the same database, so the loads run concurrently
+def load_ingested_tables(
+        dataset_names : list[str],
+        cache_dir : str = 'data_cache/ingest',
+        backend = None,
+        max_workers : int = None) -> dict[str, ibis.Table]:
+    if backend is None:
+        backend = db.get_backend()
+    with open(os.path.join(cache_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+
+    def load_parquet(dataset_name : str):
+        parquet_path = os.path.abspath(os.path.join(cache_dir, manifest[dataset_name]['parquet']))
+        cursor = backend.con.cursor()
+        cursor.execute(
+            'CREATE OR REPLACE TABLE ' + quote_identifier(dataset_name) 
+            + ' AS SELECT * FROM read_parquet(' + quote_literal(parquet_path) + ')')
+        cursor.close()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(load_parquet, dataset_names))
+
+    return {dataset_name : backend.table(dataset_name) for dataset_name in dataset_names}
+
 
 # Merge multiple Ibis tables on the specific key
 # Adding prefixes to each column based on dataset name 
+#
+# method='sequential' joins one dataset at a time, coalescing DATE after each.
+# method='spine' builds one date spine (all dates for outer joins, the first
+# table's for left joins, dates shared by every table for inner joins) and
+# left-joins every dataset onto it, so DuckDB runs the whole merge as a
+# single query with no pandas in between.  Columns are named the same way.
+# method='pivot' uses the same spine but stacks every column into long
+# (DATE, FEATURE, VALUE) rows with UNION ALL and pivots them back out; wide
+# join chains slow down sharply past ~100 tables, the pivot does not.
+# Both single-query methods assume one row per DATE in each table
 def merge_tables(
         tables_to_merge : dict[str, ibis.Table],
         join_type : str = 'outer',
-        add_names : bool = False) -> ibis.Table:
+        add_names : bool = False,
+        method : str = 'sequential') -> ibis.Table:
+
+    if method == 'spine':
+        return merge_tables_on_spine(tables_to_merge, join_type, add_names)
+    if method == 'pivot':
+        return merge_tables_by_pivot(tables_to_merge, join_type, add_names)
+    if method != 'sequential':
+        raise ValueError("method must be 'sequential', 'spine' or 'pivot', got " + str(method))
+
     join_key = 'DATE'
     merged_tables = None
 
@@ -19,7 +266,8 @@ def merge_tables(
 
         # Start with dates only
         if merged_tables is None:
-            merged_tables = ibis.memtable(curr_dset.to_pandas()['DATE'])
+            with instrument.span('prep.to_pandas', table=curr_dset_name):
+                merged_tables = ibis.memtable(curr_dset.to_pandas()['DATE'])
 
         # Rename feature columns in current dataset to include the dataset name
         if add_names:
@@ -51,54 +299,423 @@ def merge_tables(
                     
     return merged_tables
 
+
+# Accept pandas frames (e.g. a generated date range) alongside tables
+def as_ibis_tables(tables_to_merge : dict[str, ibis.Table]) -> dict[str, ibis.Table]:
+    tables = {}
+    for curr_dset_name, curr_dset in tables_to_merge.items():
+        if isinstance(curr_dset, pd.DataFrame):
+            curr_dset = ibis.memtable(curr_dset)
+        tables[curr_dset_name] = curr_dset
+    return tables
+
+
+# Final column names for a merge, following the sequential merge's rules:
+# optional dataset prefix, and a dataset prefix on any name that would collide.
+# Returns (dataset name, original column, merged column) in output order
+def get_merged_column_names(
+        tables : dict[str, ibis.Table],
+        add_names : bool = False,
+        join_key : str = 'DATE') -> list[tuple[str,str,str]]:
+    merged_columns = [join_key]
+    column_names = []
+    for curr_dset_name, curr_dset in tables.items():
+        for col in curr_dset.columns:
+            if col == join_key:
+                continue
+            new_feature_name = curr_dset_name + '_' + col if add_names else col
+            if new_feature_name in merged_columns:
+                new_feature_name = curr_dset_name + '_' + new_feature_name
+            merged_columns.append(new_feature_name)
+            column_names.append((curr_dset_name, col, new_feature_name))
+    return column_names
+
+
+def merge_tables_on_spine(
+        tables_to_merge : dict[str, ibis.Table],
+        join_type : str = 'outer',
+        add_names : bool = False) -> ibis.Table:
+    join_key = 'DATE'
+    tables = as_ibis_tables(tables_to_merge)
+    
+    # Build the date spine
+    date_tables = [curr_dset.select(join_key) for curr_dset in tables.values()]
+    if join_type == 'outer':
+        spine = ibis.union(*date_tables, distinct=True)
+    elif join_type == 'left':
+        spine = date_tables[0].distinct()
+    elif join_type == 'inner':
+        spine = ibis.intersect(*date_tables, distinct=True)
+    else:
+        raise ValueError("join_type must be 'outer', 'left' or 'inner' with method='spine', got " + str(join_type))
+
+    # Chain one left join per dataset; ibis flattens these into one multi-way join
+    merged_tables = spine
+    for curr_dset_name, curr_dset in tables.items():
+        merged_tables = merged_tables.left_join(curr_dset, join_key, lname='', rname=curr_dset_name+'_{name}')
+
+    selections = [spine[join_key]] + [
+        tables[curr_dset_name][col].name(new_feature_name)
+        for curr_dset_name, col, new_feature_name in get_merged_column_names(tables, add_names, join_key)]
+
+    return merged_tables.select(selections)
+
+
+def quote_identifier(name : str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+def quote_literal(value : str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+# Combine SELECTs with a set operator, nested as a balanced tree.  DuckDB
+# parses a flat chain as one level per operand and stops at 1000 levels
+# (~1000 tables or columns); the tree keeps the depth logarithmic
+def join_set_operation(
+        selects : list[str],
+        operator : str) -> str:
+    if len(selects) == 1:
+        return selects[0]
+    middle = len(selects) // 2
+    return ('(' + join_set_operation(selects[:middle], operator) + ') ' + operator 
+            + ' (' + join_set_operation(selects[middle:], operator) + ')')
+
+
+# Drop temp tables that a lazy SQL result reads from once the result, and
+# every expression built on it, has been garbage collected (straight away if
+# there's no result).  Temp tables never persist in a file-backed database,
+# and are already gone if their connection was closed first
+def drop_temp_tables(
+        backend,
+        table_names : list[str]):
+    for name in table_names:
+        try:
+            backend.drop_table(name, force=True)
+        except duckdb.ConnectionException:
+            return
+
+
+def drop_temp_tables_with(
+        result : ibis.Table,
+        backend,
+        table_names : list[str]):
+    if result is None:
+        drop_temp_tables(backend, table_names)
+    else:
+        weakref.finalize(result.op(), drop_temp_tables, backend, table_names)
+
+
+def merge_tables_by_pivot(
+        tables_to_merge : dict[str, ibis.Table],
+        join_type : str = 'outer',
+        add_names : bool = False) -> ibis.Table:
+    tables = as_ibis_tables(tables_to_merge)
+
+    # PIVOT has no ibis equivalent, so each input is materialized as a temp
+    # table in its DuckDB backend and the merge is written as one SQL query
+    # over them.  Views would be inlined and recomputed once per reference
+    backend = ibis.get_backend(next(iter(tables.values())))
+    input_prefix = 'merge_input_' + uuid.uuid4().hex[:8] + '_'
+    input_names = {curr_dset_name : input_prefix + str(i) for i, curr_dset_name in enumerate(tables)}
+    merged = None
+    try:
+        for curr_dset_name, curr_dset in tables.items():
+            backend.create_table(input_names[curr_dset_name], curr_dset, temp=True, overwrite=True)
+        merged = backend.sql(get_pivot_merge_query(tables, input_names, join_type, add_names))
+        return merged
+    finally:
+        drop_temp_tables_with(merged, backend, list(input_names.values()))
+
+
+def get_pivot_merge_query(
+        tables : dict[str, ibis.Table],
+        input_names : dict[str, str],
+        join_type : str,
+        add_names : bool) -> str:
+    join_key = quote_identifier('DATE')
+    inputs = [quote_identifier(input_name) for input_name in input_names.values()]
+
+    # Build the date spine
+    if join_type == 'outer':
+        spine = join_set_operation(['SELECT ' + join_key + ' FROM ' + input_table for input_table in inputs], 'UNION')
+    elif join_type == 'left':
+        spine = 'SELECT DISTINCT ' + join_key + ' FROM ' + inputs[0]
+    elif join_type == 'inner':
+        spine = join_set_operation(['SELECT ' + join_key + ' FROM ' + input_table for input_table in inputs], 'INTERSECT')
+    else:
+        raise ValueError("join_type must be 'outer', 'left' or 'inner' with method='pivot', got " + str(join_type))
+
+    # Stack columns of the same type into long rows, one pivot per type
+    column_names = get_merged_column_names(tables, add_names)
+    type_groups = {}
+    for curr_dset_name, col, new_feature_name in column_names:
+        col_type = tables[curr_dset_name][col].type()
+        type_groups.setdefault(str(col_type), []).append((curr_dset_name, col, new_feature_name))
+
+    pivots = []
+    pivot_of_column = {}
+    for i, group in enumerate(type_groups.values()):
+        long_rows = join_set_operation([
+            'SELECT ' + join_key + ', ' + quote_literal(new_feature_name) + ' AS FEATURE, ' 
+            + quote_identifier(col) + ' AS VALUE FROM ' + quote_identifier(input_names[curr_dset_name])
+            for curr_dset_name, col, new_feature_name in group], 'UNION ALL')
+        features = ', '.join(quote_literal(new_feature_name) for _, _, new_feature_name in group)
+        pivots.append('(PIVOT (' + long_rows + ') ON FEATURE IN (' + features + ') '
+                      + 'USING any_value(VALUE) GROUP BY ' + join_key + ') AS p' + str(i))
+        for _, _, new_feature_name in group:
+            pivot_of_column[new_feature_name] = 'p' + str(i)
+
+    selections = ['spine.' + join_key] + [
+        pivot_of_column[new_feature_name] + '.' + quote_identifier(new_feature_name)
+        for _, _, new_feature_name in column_names]
+    joins = ' '.join('LEFT JOIN ' + pivot + ' ON spine.' + join_key + ' = p' + str(i) + '.' + join_key
+                     for i, pivot in enumerate(pivots))
+
+    return 'SELECT ' + ', '.join(selections) + ' FROM (' + spine + ') AS spine ' + joins
+
+# Materialize a lazy expression as a uniquely named temp table in its DuckDB
+# backend, for queries that have to be written in SQL.  Unlike a view, a temp
+# table never persists in a file-backed database and doesn't depend on the
+# memtables it was built from; it's dropped along with the query's result
+def create_input_table(
+        data : ibis.Table,
+        prefix : str):
+    backend = ibis.get_backend(data)
+    input_name = prefix + uuid.uuid4().hex[:8]
+    backend.create_table(input_name, data, temp=True, overwrite=True)
+    return backend, input_name
+
+
 def impute_forward_fill_numerics(
         data: ibis.Table, 
-        sort_by : str = 'DATE') -> pd.DataFrame:
-      
-    # Convert to pandas, sorted by date
-    df = data.to_pandas().sort_values(by='DATE')
-    
-    # Identify numeric columns
-    numeric_cols = df.select_dtypes(include=['float64', 'float32', 'int64', 'int32']).columns
-    
-    # Forward fill
-    df[numeric_cols] = df[numeric_cols].ffill()
+        sort_by : str = 'DATE') -> ibis.Table:
+
+    # Forward fill runs as one window query inside DuckDB, so the result stays
+    # lazy.  ibis can't express IGNORE NULLS, so the input is registered as a
+    # temp table in its backend and the query is written in SQL over it
+    backend, input_name = create_input_table(data, 'ffill_input_')
 
-    # return dataframe with forward-filled data
-    return ibis.memtable(df)
+    order = quote_identifier(sort_by)
+    selections = []
+    for col in data.columns:
+        col_type = data[col].type()
+        value = quote_identifier(col)
+        if not (col_type.is_integer() or col_type.is_floating()):
+            selections.append(value)
+            continue
+
+        # pandas treats NaN as missing, DuckDB does not
+        if col_type.is_floating():
+            value = 'CASE WHEN isnan(' + value + ') THEN NULL ELSE ' + value + ' END'
+        selections.append(
+            'last_value(' + value + ' IGNORE NULLS) OVER (ORDER BY ' + order 
+            + ' ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW) AS ' + quote_identifier(col))
+
+    # return table with forward-filled data
+    filled = backend.sql(
+        'SELECT ' + ', '.join(selections) + ' FROM ' + quote_identifier(input_name) + ' ORDER BY ' + order)
+    drop_temp_tables_with(filled, backend, [input_name])
+    return filled
 
     
+# One row per day of year (dated in 2000, a leap year, to match the merge
+# table) and one <year>_<feature> column per year and feature, built by a
+# single DuckDB PIVOT rather than a query per feature and year
 def annual_decomposition(
         data: ibis.Table,
         decomp_features : list[str])-> ibis.Table:
 
-    df = data.to_pandas().sort_values('DATE')
-    df['DATE'] = pd.to_datetime(df['DATE'])
+    backend, input_name = create_input_table(data, 'decomp_input_')
 
-    years = df['DATE'].dt.year.unique()
-    
-    decomp_datasets = {}
-
-    # TODO reverse these for efficiency
-    for col in decomp_features:
-        for year in years:
-            
-            df_new = data.filter(data.DATE.year() == year).to_pandas()[['DATE',col]]
-            
-            # Rename feature to include year
-            # df_new[str(year) + '_' + col] = df_new[col]
-            # df_new = df_new.drop(col, axis='columns')
-
-            # Change date to 2000 to match merge table
-            df_new['DATE'] = df_new['DATE'].apply(lambda x: x.replace(year=2000))
-
-            decomp_datasets[str(year)] = ibis.memtable(df_new)
-
-    table_annual_decomp = merge_tables(
-        decomp_datasets,
-        join_type = 'outer')
+    date = quote_identifier('DATE')
+    features = [quote_identifier(col) for col in decomp_features]
+    day_of_year = ('SELECT make_date(2000, month(' + date + '), day(' + date + ')) AS ' + date 
+                   + ', CAST(year(' + date + ') AS VARCHAR) AS DECOMP_YEAR, ' + ', '.join(features) 
+                   + ' FROM ' + quote_identifier(input_name))
+    aggregates = ', '.join('any_value(' + col + ') AS ' + col for col in features)
+
+    # DuckDB names the pivoted columns <year>_<feature>
+    table_annual_decomp = backend.sql(
+        'SELECT * FROM (PIVOT (' + day_of_year + ') ON DECOMP_YEAR USING ' + aggregates 
+        + ' GROUP BY ' + date + ') ORDER BY ' + date)
+    drop_temp_tables_with(table_annual_decomp, backend, [input_name])
     
     return table_annual_decomp
 
 
 
+
+
+# Declarative feature engineering.  A feature spec is a dict of:
+#   'lags'      : {column : [steps, ...]}  -> <column>_LAG<steps>
+#   'leads'     : {column : [steps, ...]}  -> <column>_LEAD<steps>
+#   'ratios'    : {new_column : (numerator, denominator)}
+#   'deflators' : {column : deflator}      -> <column>_REAL
+#   'renames'   : {old_name : new_name}, applied last
+# Steps are rows in order_by order.  Ratios and deflators may reference
+# lag/lead outputs and earlier ratios, which are inlined, so the whole spec
+# compiles to a single select with window functions: one scan of the table
+# however many features are declared
+def compile_feature_spec(
+        data : ibis.Table,
+        spec : dict,
+        order_by : str = 'DATE') -> ibis.Table:
+    window = ibis.window(order_by=order_by)
+    features = {}
+
+    def get_column(name : str):
+        return features[name] if name in features else data[name]
+        
+    for col, steps in spec.get('lags', {}).items():
+        for step in steps:
+            features[col + '_LAG' + str(step)] = data[col].lag(step).over(window)
+
+    for col, steps in spec.get('leads', {}).items():
+        for step in steps:
+            features[col + '_LEAD' + str(step)] = data[col].lead(step).over(window)
+
+    for new_col, (numerator, denominator) in spec.get('ratios', {}).items():
+        features[new_col] = get_column(numerator) / get_column(denominator)
+
+    for col, deflator in spec.get('deflators', {}).items():
+        features[col + '_REAL'] = get_column(col) / get_column(deflator)
+
+    renames = spec.get('renames', {})
+    selections = [data[col].name(renames.get(col, col)) for col in data.columns]
+    selections += [expr.name(renames.get(name, name)) for name, expr in features.items()]
+
+    return data.select(selections).order_by(order_by)
+
+
+# Spec for the daily merged table in 01_eda_data_prep: macro indicators
+# lagged 90 days for availability, prices and wages deflated by lagged CPI,
+# and per-capita housing starts
+def get_standard_feature_spec(
+        macro_lag_steps : int = 90) -> dict:
+    lag_suffix = '_LAG' + str(macro_lag_steps)
+    cpi = 'CPI' + lag_suffix
+
+    deflated = ['WAGE', 'HOUSEPRICE']
+    for name in INV_DATASET_NAMES:
+        if name != 'VIX':
+            deflated += [name + suffix for suffix in ['_HIGH', '_LOW', '_OPEN', '_PRICE']]
+
+    renames = {name : name + '_NOLAG' for name in FRED_DATASET_NAMES}
+    for col in deflated:
+        nolag = '_NOLAG' if col in FRED_DATASET_NAMES else ''
+        renames[col] = col + nolag + '_NOMINAL'
+        renames[col + '_REAL'] = col + nolag + '_REAL'
+    renames['HOUSESTARTS'] = 'HOUSESTARTS_NOMINAL_NOLAG'
+    renames['HOUSESTARTS' + lag_suffix] = 'HOUSESTARTS_NOMINAL' + lag_suffix
+
+    return {
+        'lags' : {name : [macro_lag_steps] for name in FRED_DATASET_NAMES},
+        'ratios' : {
+            'HOUSESTARTS_PERCAPITA_NOLAG' : ('HOUSESTARTS', 'POP'),
+            'HOUSESTARTS_PERCAPITA' + lag_suffix : ('HOUSESTARTS' + lag_suffix, 'POP' + lag_suffix)},
+        'deflators' : {col : cpi for col in deflated},
+        'renames' : renames}
+
+
+# Online version of impute_forward_fill_numerics + compile_feature_spec for
+# one new day at a time.  Keeps the last forward-filled daily rows (as many
+# as the longest lag needs), so each update costs the same however long the
+# history is.  Leads need future rows and are left to the batch path.
+# daily_history is the forward-filled daily table (one row per calendar
+# day, sorted) up to the last day already processed
+class StreamingFeatureState:
+    def __init__(
+            self,
+            daily_history : pd.DataFrame,
+            spec : dict,
+            date_col : str = 'DATE'):
+
+        self.spec = spec
+        self.date_col = date_col
+        self.columns = [col for col in daily_history.columns if col != date_col]
+
+        # Same columns as impute_forward_fill_numerics fills
+        self.fill_columns = set(
+            col for col in self.columns
+            if pd.api.types.is_integer_dtype(daily_history[col]) 
+            or pd.api.types.is_float_dtype(daily_history[col]))
+
+        max_lag = max([max(steps) for steps in spec.get('lags', {}).values()], default=0)
+        recent = daily_history.tail(max_lag + 1)
+        self.dates = deque(pd.to_datetime(recent[date_col]).dt.date, maxlen=max_lag + 1)
+        self.rows = deque(recent[self.columns].to_dict('records'), maxlen=max_lag + 1)
+        self.pending_releases = []
+
+    # Record a value dated in the past (e.g. a macro release published after
+    # the period it covers).  Days already in the buffer from that date on
+    # are re-filled; values dated after the last processed day wait for it.
+    # Assumes each column's releases arrive in date order
+    def add_release(
+            self,
+            column : str,
+            date,
+            value : float):
+        date = pd.Timestamp(date).date()
+        if date > self.dates[-1]:
+            self.pending_releases.append((date, column, value))
+            return
+        for day, row in zip(self.dates, self.rows):
+            if day >= date:
+                row[column] = value
+
+    # Advance the daily spine through date, applying values observed on that
+    # date (a new bar, macro values dated that day).  Days skipped since the
+    # last update are forward-filled.  Returns the feature row for date
+    def update(
+            self,
+            date,
+            values : dict) -> dict:
+        date = pd.Timestamp(date).date()
+        if date <= self.dates[-1]:
+            raise ValueError('Already processed ' + str(self.dates[-1]) + ', got ' + str(date))
+
+        day = self.dates[-1]
+        while day < date:
+            day = day + datetime.timedelta(days=1)
+
+            # Forward fill numerics; other columns only hold same-day values
+            row = {col : (self.rows[-1][col] if col in self.fill_columns else None) for col in self.columns}
+            day_values = {column : value for release_date, column, value in self.pending_releases if release_date == day}
+            if day == date:
+                day_values.update(values)
+            for col, value in day_values.items():
+                if value is not None and not (isinstance(value, float) and np.isnan(value)):
+                    row[col] = value
+
+            self.pending_releases = [release for release in self.pending_releases if release[0] > day]
+            self.dates.append(day)
+            self.rows.append(row)
+
+        return self.get_feature_row()
+
+    # Features for the latest day, with the same names compile_feature_spec
+    # gives them
+    def get_feature_row(self) -> dict:
+        current = self.rows[-1]
+        features = {}
+
+        def get_value(name : str):
+            value = features[name] if name in features else current[name]
+            return np.float64(np.nan if value is None else value)
+
+        for col, steps in self.spec.get('lags', {}).items():
+            for step in steps:
+                lagged = self.rows[-1 - step][col] if step < len(self.rows) else None
+                features[col + '_LAG' + str(step)] = np.nan if lagged is None else lagged
+
+        for new_col, (numerator, denominator) in self.spec.get('ratios', {}).items():
+            features[new_col] = get_value(numerator) / get_value(denominator)
+
+        for col, deflator in self.spec.get('deflators', {}).items():
+            features[col + '_REAL'] = get_value(col) / get_value(deflator)
+
+        renames = self.spec.get('renames', {})
+        row = {self.date_col : self.dates[-1]}
+        row.update({renames.get(col, col) : value for col, value in current.items()})
+        row.update({renames.get(name, name) : value for name, value in features.items()})
+        return row
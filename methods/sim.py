@@ -3,8 +3,14 @@ import pandas as pd
 from typing import List, Dict, Tuple, Any
 from dataclasses import dataclass
 from sklearn.preprocessing import KBinsDiscretizer
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import datetime
-import random
+import hashlib
+import itertools
+import json
+import os
+import time
+from methods import instrument
 
 # def train():
 #     random.seed(a=random_seed, version=2)
@@ -33,6 +39,131 @@ import random
 
 
 
+# Legal actions for each current balance as a boolean mask[balance, action]:
+# any balance within rebalance_limit_steps of the current one
+def get_legal_action_mask(
+        num_balances : int,
+        rebalance_limit_steps : int) -> np.ndarray:
+    balance_inds = np.arange(num_balances)
+    return (np.abs(balance_inds[:, None] - balance_inds[None, :]) 
+            <= rebalance_limit_steps)
+
+
+# Pick, for each row, the nth True entry of a boolean mask, where n is
+# scaled from a uniform draw - the vectorized equivalent of
+# some_list[int(draw * len(some_list))] over the True positions
+def select_nth_true(mask : np.ndarray, draws : np.ndarray) -> np.ndarray:
+    counts = mask.sum(axis=1)
+    nth = (draws * counts).astype(np.int64)
+    return np.argmax(np.cumsum(mask, axis=1) > nth[:, None], axis=1)
+
+
+# Every action tied for the highest weight in one state's legal-action
+# weights, given as a list starting at first_action.  Rows are short, so
+# plain list methods beat numpy's per-call overhead, and ties are only
+# scanned for when some but not all of the row ties (unvisited states tie
+# throughout)
+def get_best_actions_in_row(
+        action_weights : list[float],
+        first_action : int) -> list[int]:
+    highest_weight = max(action_weights)
+    num_best = action_weights.count(highest_weight)
+    if num_best == 1:
+        return [first_action + action_weights.index(highest_weight)]
+    if num_best == len(action_weights):
+        return list(range(first_action, first_action + num_best))
+    return [first_action + i for i, weight in enumerate(action_weights) if weight == highest_weight]
+
+
+# Smallest signed integer type that holds every balance index and the -1
+# marking steps not yet simulated
+def get_balance_dtype(num_balances : int) -> np.dtype:
+    return np.min_scalar_type(-num_balances)
+
+
+# Market state for the agents from any number of feature columns.  fit()
+# takes quantile breakpoints per feature from training data (num_bins
+# equal-count bins, duplicate breakpoints dropped); transform() bins every
+# feature with np.searchsorted and combines the bins into one mixed-radix
+# integer, first feature most significant, so the state index runs
+# 0..get_num_states()-1 and can go straight into PortfolioAgent's bins
+# column.  A value equal to a breakpoint goes in the bin above it, as
+# 03_decisioning's value_to_bin does; NaN goes in the top bin.  save() and
+# load_state_encoder() carry the same breakpoints to test data and live days
+class StateEncoder:
+    def __init__(
+            self,
+            features : list[str],
+            num_bins : int | list[int] = 11,
+            breakpoints : dict[str, list[float]] = None):
+        self.features = list(features)
+        if isinstance(num_bins, int):
+            num_bins = [num_bins] * len(self.features)
+        self.num_bins = list(num_bins)
+        self.breakpoints = None
+        if breakpoints is not None:
+            self.breakpoints = {col : np.asarray(breakpoints[col], dtype=np.float64) for col in self.features}
+
+    def fit(self, df : pd.DataFrame):
+        self.breakpoints = {}
+        for col, num_bins in zip(self.features, self.num_bins):
+            quantiles = df[col].quantile([x/num_bins for x in range(1, num_bins)]).to_numpy(dtype=np.float64)
+            self.breakpoints[col] = np.unique(quantiles[~np.isnan(quantiles)])
+        return self
+
+    # Bins per feature, and each feature's place value in the state index
+    def get_radices(self) -> np.ndarray:
+        return np.array([len(self.breakpoints[col]) + 1 for col in self.features], dtype=np.int64)
+
+    def get_place_values(self) -> np.ndarray:
+        radices = self.get_radices()
+        return np.concatenate([np.cumprod(radices[::-1])[::-1][1:], [1]])
+
+    def get_num_states(self) -> int:
+        return int(np.prod(self.get_radices()))
+
+    # (rows, features) bins
+    def transform_bins(self, df : pd.DataFrame) -> np.ndarray:
+        if self.breakpoints is None:
+            raise ValueError('StateEncoder must be fit (or loaded) before transforming')
+        bins = np.empty((len(df), len(self.features)), dtype=np.int64)
+        for i, col in enumerate(self.features):
+            bins[:, i] = np.searchsorted(self.breakpoints[col], df[col].to_numpy(dtype=np.float64), side='right')
+        return bins
+
+    def transform(self, df : pd.DataFrame) -> np.ndarray:
+        return self.transform_bins(df) @ self.get_place_values()
+
+    # State index for a single row of values, e.g. one live day
+    def transform_row(self, values : dict) -> int:
+        state = 0
+        for col, radix in zip(self.features, self.get_radices()):
+            state = state * radix + int(np.searchsorted(self.breakpoints[col], values[col], side='right'))
+        return state
+
+    # Back from state indices to (rows, features) bins
+    def inverse_transform(self, states : np.ndarray) -> np.ndarray:
+        states = np.asarray(states, dtype=np.int64)
+        return (states[:, None] // self.get_place_values()) % self.get_radices()
+
+    # Written atomically, like the pipeline's other outputs
+    def save(self, path : str):
+        encoder = {
+            'features' : self.features,
+            'num_bins' : self.num_bins,
+            'breakpoints' : {col : self.breakpoints[col].tolist() for col in self.features}}
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(encoder, f, indent=2)
+        os.replace(tmp_path, path)
+
+
+def load_state_encoder(path : str) -> StateEncoder:
+    with open(path) as f:
+        encoder = json.load(f)
+    return StateEncoder(encoder['features'], encoder['num_bins'], encoder['breakpoints'])
+
+
 # https://en.wikipedia.org/wiki/Reinforcement_learning
 class PortfolioAgent:
     def __init__(
@@ -49,7 +180,15 @@ class PortfolioAgent:
             # state and action rules
             rebalance_limit_steps : int = 2,
             asset_balance_steps : list = [x/10.0 for x in range(11)],
-            random_seed : int = 42):
+            random_seed : int = 42,
+            
+            # Store weights as a dense ndarray instead of nested dicts
+            dense_weights : bool = False,
+
+            # Number of market states (e.g. StateEncoder.get_num_states()),
+            # so states missing from data still get weights; None sizes the
+            # table from the largest state in data
+            num_pred_bins : int = None):
 
         # learning and exploration
         self.learning_rate = learning_rate
@@ -58,34 +197,77 @@ class PortfolioAgent:
         # state and action rules
         self.rebalance_limit_steps = rebalance_limit_steps
         self.asset_balance_steps = asset_balance_steps
+        self.asset_balance_values = np.asarray(asset_balance_steps, dtype=np.float64)
 
         # Data
-        self.data = data[[date_col,price_delta_pred_bins_col,price_delta_col]]
+        self._data = data[[date_col,price_delta_pred_bins_col,price_delta_col]]
         self.date_col = date_col # For display and coordination, mainly
         self.price_delta_pred_bins_col = price_delta_pred_bins_col # For making decisions
         self.price_delta_col = price_delta_col # Used to calculate reward
+
+        # Columns used while stepping, pulled out of the DataFrame once.
+        # They live in buffers that append_data grows by doubling, so new
+        # days can be added without copying the history each time; the
+        # properties below expose the first num_steps entries
+        self.num_steps = len(data)
+        self._dates = data[date_col].to_numpy().copy()
+        self._price_delta_pred_bins = np.ascontiguousarray(data[price_delta_pred_bins_col].to_numpy(dtype=np.int64))
+        self._price_delta = np.ascontiguousarray(data[price_delta_col].to_numpy(dtype=np.float64))
         
-        # States over time
-        self.asset_balance_at_open_ind = [np.NaN for x in range(len(data))]
-        self.asset_balance_at_open_ind[0] = 0
+        # States over time, preallocated for the whole episode
+        # (-1 / NaN mark steps not yet simulated)
+        self._asset_balance_at_open_ind = np.full(len(data), -1, dtype=get_balance_dtype(len(asset_balance_steps)))
+        self._asset_balance_at_open_ind[0] = 0
         self.current_step = 0
 
-        self.portfolio_value = [np.NaN for x in range(len(data))]
-        self.portfolio_value[0] = 1000000
+        self._portfolio_value = np.full(len(data), np.nan, dtype=np.float64)
+        self._portfolio_value[0] = 1000000
 
-        random.seed = random_seed
+        # Weights each decision is credited with when learning (see
+        # get_decision_weight), one entry per step taken.  Recorded as
+        # decisions are made so learning doesn't re-read the history
+        self.decision_weights = []
 
-        # Build the policy-learning matrix
-        # dict[(int,int) -> dict[int -> float]]
-        # Outer dictionary maps state(current portfolio state, 
-        # market forecast) to action (a rebalanced portfolio state)
-        # Inner dictionary maps action to weight
-        self.state_action_weight_matrix = {}
+        # Each agent draws from its own seeded generator so runs are reproducible.
+        # Every step consumes exactly two uniforms (explore roll, choice roll),
+        # which lets PortfolioPopulation replay the same stream in blocks.
+        # The agent takes its draws from the stream in blocks too, in order,
+        # so results are the same as drawing one step at a time
+        self.rng = np.random.default_rng(random_seed)
+        self.draw_block_steps = 256
+        self.random_draws = []
+        self.random_draw_ind = 0
 
-        unique_pred_bins = data[price_delta_pred_bins_col].nunique()
+        # Legal actions are fixed by the rules, so compute them once, and
+        # keep Python copies of what each step reads one value at a time
+        self.legal_action_mask = get_legal_action_mask(len(asset_balance_steps), rebalance_limit_steps)
+        self.legal_actions = [np.flatnonzero(mask).tolist() for mask in self.legal_action_mask]
+        self.asset_balance_value_list = self.asset_balance_values.tolist()
 
-        for current_asset_balance_ind in range(len(asset_balance_steps)):
-            for fc_delta_bin in range(unique_pred_bins):
+        if num_pred_bins is None:
+            num_pred_bins = int(data[price_delta_pred_bins_col].max()) + 1
+
+        self.dense_weights = dense_weights
+        if dense_weights:
+            # Build the policy-learning matrix as an ndarray
+            # [current balance, prediction bin, new balance] -> weight
+            # Illegal actions stay at zero and are masked out when deciding
+            self.state_action_weight_matrix = np.zeros(
+                (len(asset_balance_steps), num_pred_bins, len(asset_balance_steps)),
+                dtype=np.float64)
+            self.set_legal_weight_rows()
+        else:
+            # Build the policy-learning matrix
+            # dict[(int,int) -> dict[int -> float]]
+            # Outer dictionary maps state(current portfolio state, 
+            # market forecast) to action (a rebalanced portfolio state)
+            # Inner dictionary maps action to weight
+            self.state_action_weight_matrix = {}
+            self.add_weight_states(0, num_pred_bins)
+
+    def add_weight_states(self, first_pred_bin : int, num_pred_bins : int):
+        for current_asset_balance_ind in range(len(self.asset_balance_steps)):
+            for fc_delta_bin in range(first_pred_bin, num_pred_bins):
                 
                 state = (current_asset_balance_ind,fc_delta_bin)
 
@@ -96,75 +278,178 @@ class PortfolioAgent:
                     action_dict[action] = 0
                 self.state_action_weight_matrix[state] = action_dict
 
-    
+    # Views of each state's legal actions in the dense table.  Legal actions
+    # are the balances within rebalance_limit_steps of the current one, a
+    # contiguous slice of the row, so deciding is a max over one view
+    # rather than a masked argmax over the whole row
+    def set_legal_weight_rows(self):
+        num_balances, num_pred_bins, _ = self.state_action_weight_matrix.shape
+        self.legal_weight_rows = [
+            [self.state_action_weight_matrix[
+                balance, pred_bin, max(balance - self.rebalance_limit_steps, 0):balance + self.rebalance_limit_steps + 1]
+             for pred_bin in range(num_pred_bins)]
+            for balance in range(num_balances)]
+
+    # Where a decision's rewards are credited when learning, as (weight row,
+    # index in the row): the dict table's inner dict and the action, or the
+    # dense table's legal-action view and the action's offset in it
+    def get_decision_weight(self, balance : int, pred_bin : int, action : int) -> tuple:
+        if self.dense_weights:
+            return (self.legal_weight_rows[balance][pred_bin],
+                    action - max(balance - self.rebalance_limit_steps, 0))
+        return (self.state_action_weight_matrix[balance, pred_bin], action)
+
+    def get_num_pred_bins(self) -> int:
+        if self.dense_weights:
+            return self.state_action_weight_matrix.shape[1]
+        return len(self.state_action_weight_matrix) // len(self.asset_balance_steps)
+
+    @property
+    def data(self) -> pd.DataFrame:
+        # Rebuilt from the buffers only after new days have been appended
+        if len(self._data) != self.num_steps:
+            self._data = pd.DataFrame({
+                self.date_col : self._dates[:self.num_steps],
+                self.price_delta_pred_bins_col : self._price_delta_pred_bins[:self.num_steps],
+                self.price_delta_col : self._price_delta[:self.num_steps]})
+        return self._data
+
+    @property
+    def price_delta_pred_bins(self) -> np.ndarray:
+        return self._price_delta_pred_bins[:self.num_steps]
+
+    @property
+    def price_delta(self) -> np.ndarray:
+        return self._price_delta[:self.num_steps]
+
+    @property
+    def asset_balance_at_open_ind(self) -> np.ndarray:
+        return self._asset_balance_at_open_ind[:self.num_steps]
+
+    @property
+    def portfolio_value(self) -> np.ndarray:
+        return self._portfolio_value[:self.num_steps]
+
+    # Extend the episode with new days (e.g. one new trading day at a time)
+    # so step() can continue past the original data.  Buffers double when
+    # full, so appending costs amortized constant time per day.  Prediction
+    # bins not seen before get fresh (zero) weights
+    def append_data(self, data : pd.DataFrame):
+        num_new = len(data)
+        num_steps = self.num_steps + num_new
+        capacity = len(self._price_delta)
+        if num_steps > capacity:
+            capacity = max(num_steps, 2 * capacity)
+            self._dates = self.grow_buffer(self._dates, capacity, None)
+            self._price_delta_pred_bins = self.grow_buffer(self._price_delta_pred_bins, capacity, 0)
+            self._price_delta = self.grow_buffer(self._price_delta, capacity, np.nan)
+            self._asset_balance_at_open_ind = self.grow_buffer(self._asset_balance_at_open_ind, capacity, -1)
+            self._portfolio_value = self.grow_buffer(self._portfolio_value, capacity, np.nan)
+
+        new_pred_bins = data[self.price_delta_pred_bins_col].to_numpy(dtype=np.int64)
+        self._dates[self.num_steps:num_steps] = data[self.date_col].to_numpy()
+        self._price_delta_pred_bins[self.num_steps:num_steps] = new_pred_bins
+        self._price_delta[self.num_steps:num_steps] = data[self.price_delta_col].to_numpy(dtype=np.float64)
+        self.num_steps = num_steps
+
+        num_pred_bins = self.get_num_pred_bins()
+        if num_new > 0 and new_pred_bins.max() >= num_pred_bins:
+            if self.dense_weights:
+                self.state_action_weight_matrix = np.pad(
+                    self.state_action_weight_matrix,
+                    ((0, 0), (0, new_pred_bins.max() + 1 - num_pred_bins), (0, 0)))
+                self.set_legal_weight_rows()
+
+                # Recorded rows are views of the old table
+                balances = self._asset_balance_at_open_ind[:self.current_step+1]
+                self.decision_weights = [
+                    self.get_decision_weight(balance, pred_bin, action)
+                    for balance, pred_bin, action in zip(
+                        balances[:-1].tolist(),
+                        self._price_delta_pred_bins[:self.current_step].tolist(),
+                        balances[1:].tolist())]
+            else:
+                self.add_weight_states(num_pred_bins, new_pred_bins.max() + 1)
+
+    def grow_buffer(self, buffer : np.ndarray, capacity : int, fill) -> np.ndarray:
+        grown = np.empty(capacity, dtype=buffer.dtype)
+        grown[:len(buffer)] = buffer
+        if fill is not None:
+            grown[len(buffer):] = fill
+        return grown
+
 
     def get_current_state_for_decision(self)->tuple[int,int]:
-        return (self.asset_balance_at_open_ind[self.current_step], #Current asset balance
-                self.data[self.price_delta_pred_bins_col].iat[self.current_step+1])  #Predicted next price delta
+        return (self._asset_balance_at_open_ind.item(self.current_step), #Current asset balance
+                self._price_delta_pred_bins.item(self.current_step+1))  #Predicted next price delta
 
     def get_legal_actions_provisional(self, asset_bal)->int:
         return [x for x in range(len(self.asset_balance_steps)) 
                 if abs(x - asset_bal) <= self.rebalance_limit_steps]
     
-    def get_legal_actions(self)->int:
-        return [x for x in range(len(self.asset_balance_steps)) 
-                    if abs(x - self.asset_balance_at_open_ind[self.current_step]) 
-                    <= self.rebalance_limit_steps]
-
-    def get_best_action(self)->int:
-
-        action_weight_matrix = self.state_action_weight_matrix[self.get_current_state_for_decision()]
-        highest_weights = None
-        best_actions = []
-
-        # Get highest weight and best actions
-        for action,weight in action_weight_matrix.items():
-            if highest_weights is None:
-                best_actions.append(action)
-                highest_weight = weight
-            elif weight == highest_weight:
-                best_actions.append(action)
-            elif weight > highest_weight:
-                best_actions = [action]
-                highest_weight = weight
-            else:
-                pass
+    def get_legal_actions(self)->list[int]:
+        return self.legal_actions[self._asset_balance_at_open_ind.item(self.current_step)]
+
+    # The next num_draws uniforms from the agent's stream
+    def get_random_draws(self, num_draws : int)->list[float]:
+        start = self.random_draw_ind
+        if start + num_draws > len(self.random_draws):
+            self.random_draws = self.random_draws[start:] + self.rng.random(2 * self.draw_block_steps).tolist()
+            start = 0
+        self.random_draw_ind = start + num_draws
+        return self.random_draws[start:start + num_draws]
+
+    def get_best_action(self, choice_draw : float = None)->int:
+
+        if self.dense_weights:
+            best_actions = self.get_best_actions_dense()
+        else:
+            best_actions = self.get_best_actions_dict()
 
         # Randomly select from the best actions
-        return random.choice(best_actions)
+        if choice_draw is None:
+            choice_draw = self.get_random_draws(1)[0]
+        return best_actions[int(choice_draw * len(best_actions))]
 
+    def get_best_actions_dense(self)->list[int]:
+        balance, pred_bin = self.get_current_state_for_decision()
+        return get_best_actions_in_row(
+            self.legal_weight_rows[balance][pred_bin].tolist(),
+            max(balance - self.rebalance_limit_steps, 0))
 
-    def get_prev_states_lookback(self,num_steps : int)-> list[tuple[int,int]]:
-        prev_states = []
-        for i in range (max(self.current_step-num_steps,0), self.current_step):
-            prev_states.append((self.asset_balance_at_open_ind[i], 
-                self.data[self.price_delta_pred_bins_col].iat[i]))        
-        return prev_states
+    def get_best_actions_dict(self)->list[int]:
+        balance, pred_bin = self.get_current_state_for_decision()
 
-    def get_prev_actions_lookback(self, num_steps : int)-> list[int]:
-        prev_actions = []
-        for i in range (max(self.current_step-num_steps,0), self.current_step):
-            prev_actions.append(self.asset_balance_at_open_ind[i+1])
-        return prev_actions
+        # Inner dicts hold the legal actions in order, starting from the
+        # lowest legal balance
+        return get_best_actions_in_row(
+            list(self.state_action_weight_matrix[balance, pred_bin].values()),
+            max(balance - self.rebalance_limit_steps, 0))
 
-    def update_weights_indiscriminate_lookback(self, num_steps : int):
-        prev_states = self.get_prev_states_lookback(num_steps)
-        prev_actions = self.get_prev_actions_lookback(num_steps)
 
-        # print(prev_states)
-        # print(prev_actions)
+    # Lookback history as array slices: (balances, prediction bins) of
+    # previous states and the actions (new balances) taken from them
+    def get_prev_states_lookback(self,num_steps : int)-> tuple[np.ndarray,np.ndarray]:
+        lookback_start = max(self.current_step-num_steps,0)
+        return (self._asset_balance_at_open_ind[lookback_start:self.current_step], 
+                self._price_delta_pred_bins[lookback_start:self.current_step])
+
+    def get_prev_actions_lookback(self, num_steps : int)-> np.ndarray:
+        lookback_start = max(self.current_step-num_steps,0)
+        return self._asset_balance_at_open_ind[lookback_start+1:self.current_step+1]
+
+    def update_weights_indiscriminate_lookback(self, num_steps : int):
+        current_step = self.current_step
 
         # Reward based on daily change in value of portfolio
-        reward = (self.data[self.price_delta_col].iat[self.current_step]
-                  * self.asset_balance_steps[self.asset_balance_at_open_ind[self.current_step]])
+        reward = (self._price_delta.item(current_step)
+                  * self.asset_balance_value_list[self._asset_balance_at_open_ind.item(current_step)])
         
         weight_update = reward * self.learning_rate
-        
-        # print(str(weight_update))
 
-        for i in range(len(prev_states)):
-            new_val = self.state_action_weight_matrix[prev_states[i]][prev_actions[i]] + weight_update
-            self.state_action_weight_matrix[prev_states[i]][prev_actions[i]] = new_val
+        # Lookbacks are short, so a plain loop beats fancy-indexed updates
+        for action_weights, weight_ind in self.decision_weights[max(current_step-num_steps,0):current_step]:
+            action_weights[weight_ind] += weight_update
 
     def step(self, 
             exploring : bool,
@@ -172,28 +457,18 @@ class PortfolioAgent:
             learning_lookback_steps: int = 5):
 
         # STOP If we're out of data for simulation
-        if self.current_step + 1 >= len(self.data):
+        if self.current_step + 1 >= self.num_steps:
             # probably need to throw an error or something
             return False
 
-        # Make decision
-        if exploring and random.random() < self.explore_chance:
-            self.asset_balance_at_open_ind[self.current_step+1] = random.choice(self.get_legal_actions()) # Choose randomly among legal actions
-        else: 
-            self.asset_balance_at_open_ind[self.current_step+1] = self.get_best_action()  # Get highest-weighted choice
+        if instrument.enabled:
+            return self.step_instrumented(exploring, learning, learning_lookback_steps)
+
+        self.decide(exploring)
         
         # Iterate to next step and learn from decision
         self.current_step = self.current_step + 1
-
-        # Update portfolio value
-        commodity_value = (self.portfolio_value[self.current_step-1]
-                                 * self.asset_balance_steps[self.asset_balance_at_open_ind[self.current_step]] 
-                                 * self.data[self.price_delta_col].iat[self.current_step])
-
-        cash_value = (self.portfolio_value[self.current_step-1]
-                                 * 1 - self.asset_balance_steps[self.asset_balance_at_open_ind[self.current_step]]) 
-
-        self.portfolio_value[self.current_step] = commodity_value + cash_value
+        self.update_portfolio_value()
 
         # Learn from previous actions
         if learning:
@@ -201,9 +476,669 @@ class PortfolioAgent:
 
         return True
 
+    # step() with each phase timed; kept separate so the uninstrumented
+    # step pays for a single flag check
+    def step_instrumented(self, 
+            exploring : bool,
+            learning : bool,
+            learning_lookback_steps: int = 5):
+        with instrument.span('sim.decide'):
+            self.decide(exploring)
+        self.current_step = self.current_step + 1
+        with instrument.span('sim.update_portfolio_value'):
+            self.update_portfolio_value()
+        if learning:
+            with instrument.span('sim.learn'):
+                self.update_weights_indiscriminate_lookback(num_steps=learning_lookback_steps)
+        return True
+
+    # Choose the balance to hold at the next step's open
+    def decide(self, exploring : bool):
+        explore_draw, choice_draw = self.get_random_draws(2)
+        if exploring and explore_draw < self.explore_chance:
+            legal_actions = self.get_legal_actions()
+            action = legal_actions[int(choice_draw * len(legal_actions))] # Choose randomly among legal actions
+        else: 
+            action = self.get_best_action(choice_draw)  # Get highest-weighted choice
+        self._asset_balance_at_open_ind[self.current_step+1] = action
+
+        # Learning credits the state the decision was made from, with the
+        # bin for this step
+        self.decision_weights.append(self.get_decision_weight(
+            self._asset_balance_at_open_ind.item(self.current_step),
+            self._price_delta_pred_bins.item(self.current_step),
+            action))
+
+    def update_portfolio_value(self):
+        balance_value = self.asset_balance_value_list[self._asset_balance_at_open_ind.item(self.current_step)]
+        prev_value = self._portfolio_value.item(self.current_step-1)
+        commodity_value = (prev_value
+                                 * balance_value 
+                                 * self._price_delta.item(self.current_step))
+
+        cash_value = (prev_value
+                                 * 1 - balance_value) 
+
+        self._portfolio_value[self.current_step] = commodity_value + cash_value
+
     def print_model(self):
+        if self.dense_weights:
+            num_balances, num_pred_bins, _ = self.state_action_weight_matrix.shape
+            for state in np.ndindex(num_balances, num_pred_bins):
+                print('State (Current Portfolio Balance, Prediction Bin):  ' + str(state) + ' -> ')
+                for action in np.flatnonzero(self.legal_action_mask[state[0]]):
+                    print('     Action (New Portfolio Weight)->Weight:  ' + str(action) + ' -> ' 
+                          + str(self.state_action_weight_matrix[state][action]))
+            return
+
         for state,action_weight_matrix in self.state_action_weight_matrix.items():
             print('State (Current Portfolio Balance, Prediction Bin):  ' + str(state) + ' -> ')
             for action,weight in action_weight_matrix.items():
                 print('     Action (New Portfolio Weight)->Weight:  ' + str(action) + ' -> ' + str(weight))
 
+
+
+# Runs many PortfolioAgents side by side over the same data.
+# All state carries a leading agent axis, so explore, greedy and learn
+# steps advance every agent at once.  For the same seeds, results match
+# independent PortfolioAgent runs exactly.
+class PortfolioPopulation:
+    def __init__(
+            self, 
+            data : pd.DataFrame,
+            date_col : str,
+            price_delta_pred_bins_col : str, 
+            price_delta_col : str,
+            num_agents : int = 500,
+            
+            # Hyperparameters: learning and exploring
+            learning_rate : float = 0.05,
+            explore_chance : float = 0.3,
+
+            # state and action rules
+            rebalance_limit_steps : int = 2,
+            asset_balance_steps : list = [x/10.0 for x in range(11)],
+            random_seeds : list = None,
+            draw_block_steps : int = 256,
+            num_pred_bins : int = None):  # as for PortfolioAgent
+
+        if random_seeds is None:
+            random_seeds = list(range(num_agents))
+        if len(random_seeds) != num_agents:
+            raise ValueError('Expected ' + str(num_agents) + ' random seeds, got ' + str(len(random_seeds)))
+
+        # learning and exploration
+        self.learning_rate = learning_rate
+        self.explore_chance = explore_chance
+
+        # state and action rules
+        self.rebalance_limit_steps = rebalance_limit_steps
+        self.asset_balance_steps = asset_balance_steps
+        self.asset_balance_values = np.asarray(asset_balance_steps, dtype=np.float64)
+
+        # Data - shared by all agents, held as plain arrays
+        self.data = data[[date_col,price_delta_pred_bins_col,price_delta_col]]
+        self.date_col = date_col
+        self.price_delta_pred_bins_col = price_delta_pred_bins_col
+        self.price_delta_col = price_delta_col
+        self.price_delta_pred_bins = data[price_delta_pred_bins_col].to_numpy(dtype=np.int64)
+        self.price_delta = data[price_delta_col].to_numpy(dtype=np.float64)
+        self.num_steps = len(data)
+
+        # States over time: one row per agent
+        self.num_agents = num_agents
+        self.agent_index = np.arange(num_agents)
+        self.asset_balance_at_open_ind = np.full((num_agents, self.num_steps), -1, dtype=get_balance_dtype(len(asset_balance_steps)))
+        self.asset_balance_at_open_ind[:, 0] = 0
+        self.current_step = 0
+
+        self.portfolio_value = np.full((num_agents, self.num_steps), np.nan, dtype=np.float64)
+        self.portfolio_value[:, 0] = 1000000
+
+        # One generator per agent, seeded exactly as PortfolioAgent would be.
+        # Draws are taken in blocks of steps to keep per-step overhead low
+        self.rngs = [np.random.default_rng(seed) for seed in random_seeds]
+        self.draw_block_steps = draw_block_steps
+        self.random_draws = None
+
+        # Legal actions for each current balance: mask[balance, action]
+        num_balances = len(asset_balance_steps)
+        self.legal_action_mask = get_legal_action_mask(num_balances, rebalance_limit_steps)
+
+        # Policy-learning matrix, dense:
+        # [agent, current balance, prediction bin, new balance] -> weight
+        # Illegal actions are never updated and are masked out when deciding
+        if num_pred_bins is None:
+            num_pred_bins = int(data[price_delta_pred_bins_col].max()) + 1
+        self.state_action_weight_matrix = np.zeros(
+            (num_agents, num_balances, num_pred_bins, num_balances), 
+            dtype=np.float64)
+
+    def get_random_draws(self) -> np.ndarray:
+        # Refill the (agent, step, 2) block when the previous one is used up
+        block_offset = self.current_step % self.draw_block_steps
+        if block_offset == 0 or self.random_draws is None:
+            self.random_draws = np.stack(
+                [rng.random((self.draw_block_steps, 2)) for rng in self.rngs])
+        return self.random_draws[:, block_offset, :]
+
+    def get_best_actions(self, choice_draws : np.ndarray) -> np.ndarray:
+        current_balances = self.asset_balance_at_open_ind[:, self.current_step]
+        pred_bin = self.price_delta_pred_bins[self.current_step+1]
+
+        # Masked argmax with random tie-breaking
+        action_weights = self.state_action_weight_matrix[self.agent_index, current_balances, pred_bin]
+        action_weights = np.where(self.legal_action_mask[current_balances], action_weights, -np.inf)
+        best_actions = action_weights == action_weights.max(axis=1, keepdims=True)
+        return select_nth_true(best_actions, choice_draws)
+
+    def update_weights_indiscriminate_lookback(self, num_steps : int):
+        lookback_start = max(self.current_step-num_steps,0)
+        prev_balances = self.asset_balance_at_open_ind[:, lookback_start:self.current_step]
+        prev_pred_bins = self.price_delta_pred_bins[lookback_start:self.current_step]
+        prev_actions = self.asset_balance_at_open_ind[:, lookback_start+1:self.current_step+1]
+
+        # Reward based on daily change in value of portfolio
+        reward = (self.price_delta[self.current_step]
+                  * self.asset_balance_values[self.asset_balance_at_open_ind[:, self.current_step]])
+        
+        weight_update = reward * self.learning_rate
+
+        # Unbuffered add so repeated (state, action) pairs accumulate in order
+        np.add.at(
+            self.state_action_weight_matrix,
+            (self.agent_index[:, None], prev_balances, prev_pred_bins[None, :], prev_actions),
+            weight_update[:, None])
+
+    def step(self, 
+            exploring : bool,
+            learning : bool,
+            learning_lookback_steps: int = 5):
+
+        # STOP If we're out of data for simulation
+        if self.current_step + 1 >= self.num_steps:
+            return False
+
+        # Make decisions for all agents
+        draws = self.get_random_draws()
+        actions = self.get_best_actions(draws[:, 1])
+        if exploring:
+            current_balances = self.asset_balance_at_open_ind[:, self.current_step]
+            random_actions = select_nth_true(self.legal_action_mask[current_balances], draws[:, 1])
+            actions = np.where(draws[:, 0] < self.explore_chance, random_actions, actions)
+        self.asset_balance_at_open_ind[:, self.current_step+1] = actions
+
+        # Iterate to next step and learn from decisions
+        self.current_step = self.current_step + 1
+
+        # Update portfolio values
+        balance_values = self.asset_balance_values[self.asset_balance_at_open_ind[:, self.current_step]]
+        commodity_value = (self.portfolio_value[:, self.current_step-1]
+                                 * balance_values 
+                                 * self.price_delta[self.current_step])
+
+        cash_value = (self.portfolio_value[:, self.current_step-1]
+                                 * 1 - balance_values) 
+
+        self.portfolio_value[:, self.current_step] = commodity_value + cash_value
+
+        # Learn from previous actions
+        if learning:
+            self.update_weights_indiscriminate_lookback(num_steps=learning_lookback_steps)
+
+        return True
+
+    def run(self,
+            exploring : bool,
+            learning : bool,
+            learning_lookback_steps: int = 5) -> np.ndarray:
+        while self.step(exploring, learning, learning_lookback_steps):
+            pass
+        return self.portfolio_value[:, self.current_step]
+
+
+# PortfolioAgent's learner spread over several assets.  The allocation is a
+# vector of whole units per asset (allocation_units units make up the
+# portfolio; what's left is cash), never an enumerated joint allocation,
+# so memory and work grow linearly with the number of assets.  Each asset
+# keeps its own weight table [asset, current units, prediction bin, new
+# units], like PortfolioAgent's dense table, and is rewarded with its own
+# contribution to the portfolio's daily change.
+#
+# Actions are bounded: each asset moves at most rebalance_limit_units per
+# step and holds at most max_asset_units.  When the chosen increases
+# together exceed the cash available, they're granted in a random order
+# until it runs out.  Missing deltas (an asset not trading that day) count
+# as no change
+class MultiAssetAgent:
+    def __init__(
+            self,
+            data : pd.DataFrame,
+            date_col : str,
+            price_delta_pred_bins_cols : list[str],
+            price_delta_cols : list[str],
+
+            # Hyperparameters: learning and exploring
+            learning_rate : float = 0.05,
+            explore_chance : float = 0.3,
+
+            # allocation and action rules
+            allocation_units : int = 10,
+            max_asset_units : int = None,
+            rebalance_limit_units : int = 1,
+            random_seed : int = 42,
+
+            # Per asset; None sizes each from the largest bin in data
+            num_pred_bins : int = None):
+
+        if len(price_delta_pred_bins_cols) != len(price_delta_cols):
+            raise ValueError('Expected one prediction bin column per price delta column')
+
+        # learning and exploration
+        self.learning_rate = learning_rate
+        self.explore_chance = explore_chance
+
+        # allocation and action rules
+        if max_asset_units is None:
+            max_asset_units = allocation_units
+        if max_asset_units > np.iinfo(np.int8).max:
+            raise ValueError('At most ' + str(np.iinfo(np.int8).max) + ' units per asset are supported')
+        self.allocation_units = allocation_units
+        self.max_asset_units = max_asset_units
+        self.rebalance_limit_units = rebalance_limit_units
+        self.legal_action_mask = get_legal_action_mask(max_asset_units + 1, rebalance_limit_units)
+
+        # Data, as (step, asset) arrays
+        self.data = data[[date_col] + list(price_delta_pred_bins_cols) + list(price_delta_cols)]
+        self.date_col = date_col
+        self.price_delta_pred_bins_cols = list(price_delta_pred_bins_cols)
+        self.price_delta_cols = list(price_delta_cols)
+        self.price_delta_pred_bins = np.ascontiguousarray(data[price_delta_pred_bins_cols].to_numpy(dtype=np.int64))
+        self.price_delta = np.nan_to_num(data[price_delta_cols].to_numpy(dtype=np.float64))
+        self.num_steps = len(data)
+        self.num_assets = len(price_delta_cols)
+        self.asset_index = np.arange(self.num_assets)
+
+        # Units held over time, starting all cash
+        self.units_at_open = np.zeros((self.num_steps, self.num_assets), dtype=np.int8)
+        self.current_step = 0
+
+        self.portfolio_value = np.full(self.num_steps, np.nan, dtype=np.float64)
+        self.portfolio_value[0] = 1000000
+
+        self.rng = np.random.default_rng(random_seed)
+
+        if num_pred_bins is None:
+            num_pred_bins = int(self.price_delta_pred_bins.max()) + 1
+        self.state_action_weight_matrix = np.zeros(
+            (self.num_assets, max_asset_units + 1, num_pred_bins, max_asset_units + 1),
+            dtype=np.float64)
+
+    # Fraction of the portfolio in each asset, per step
+    @property
+    def allocations(self) -> np.ndarray:
+        return self.units_at_open / self.allocation_units
+
+    def decide(self, exploring : bool) -> np.ndarray:
+        current_units = self.units_at_open[self.current_step].astype(np.int64)
+        pred_bins = self.price_delta_pred_bins[self.current_step+1]
+        draws = self.rng.random((self.num_assets, 2))
+
+        # Per-asset masked argmax with random tie-breaking, as PortfolioPopulation does per agent
+        legal = self.legal_action_mask[current_units]
+        action_weights = np.where(legal, self.state_action_weight_matrix[self.asset_index, current_units, pred_bins], -np.inf)
+        actions = select_nth_true(action_weights == action_weights.max(axis=1, keepdims=True), draws[:, 1])
+        if exploring:
+            random_actions = select_nth_true(legal, draws[:, 1])
+            actions = np.where(draws[:, 0] < self.explore_chance, random_actions, actions)
+
+        # Keep the total within allocation_units
+        if actions.sum() > self.allocation_units:
+            kept = np.minimum(actions, current_units)
+            order = self.rng.permutation(self.num_assets)
+            increases = (actions - kept)[order]
+            room = self.allocation_units - kept.sum()
+            kept[order] += np.minimum(np.maximum(room - (np.cumsum(increases) - increases), 0), increases)
+            actions = kept
+        return actions
+
+    def step(self, 
+            exploring : bool,
+            learning : bool,
+            learning_lookback_steps: int = 5):
+
+        # STOP If we're out of data for simulation
+        if self.current_step + 1 >= self.num_steps:
+            return False
+
+        self.units_at_open[self.current_step+1] = self.decide(exploring)
+        self.current_step = self.current_step + 1
+
+        # Update portfolio value: every asset's share times its delta, at once
+        contributions = self.units_at_open[self.current_step] / self.allocation_units * self.price_delta[self.current_step]
+        self.portfolio_value[self.current_step] = self.portfolio_value[self.current_step-1] * (1 + contributions.sum())
+
+        # Learn from previous actions
+        if learning:
+            self.update_weights_indiscriminate_lookback(contributions, learning_lookback_steps)
+
+        return True
+
+    # Each asset's last num_steps (units, bin) -> new units choices are
+    # rewarded with that asset's share of today's change
+    def update_weights_indiscriminate_lookback(
+            self, 
+            contributions : np.ndarray,
+            num_steps : int):
+        lookback_start = max(self.current_step-num_steps,0)
+        prev_units = self.units_at_open[lookback_start:self.current_step]
+        prev_pred_bins = self.price_delta_pred_bins[lookback_start:self.current_step]
+        prev_actions = self.units_at_open[lookback_start+1:self.current_step+1]
+
+        # Unbuffered add so repeated (state, action) pairs accumulate in order
+        np.add.at(
+            self.state_action_weight_matrix,
+            (self.asset_index[None, :], prev_units, prev_pred_bins, prev_actions),
+            (contributions * self.learning_rate)[None, :])
+
+    def run(self,
+            exploring : bool,
+            learning : bool,
+            learning_lookback_steps: int = 5) -> float:
+        while self.step(exploring, learning, learning_lookback_steps):
+            pass
+        return self.portfolio_value[self.current_step]
+
+
+# Independent, reproducible random streams for each agent in an experiment.
+# Agent i always gets child i of the master seed, no matter how the
+# agents are split across tasks or processes
+def get_agent_seeds(
+        master_seed : int,
+        agent_inds : list[int]) -> list[np.random.SeedSequence]:
+    return [np.random.SeedSequence(entropy=master_seed, spawn_key=(i,)) for i in agent_inds]
+
+
+# Worker-side copy of the experiment data, set once per process by the
+# pool initializer so tasks only carry agent indices and parameters
+_experiment_data = None
+
+def _init_experiment_worker(data : pd.DataFrame):
+    global _experiment_data
+    _experiment_data = data
+
+def _run_experiment_task(
+        agent_inds : list[int],
+        master_seed : int,
+        population_params : dict,
+        step_params : dict) -> tuple[list[int], np.ndarray, float]:
+    start_time = time.perf_counter()
+
+    population = PortfolioPopulation(
+        data = _experiment_data,
+        num_agents = len(agent_inds),
+        random_seeds = get_agent_seeds(master_seed, agent_inds),
+        **population_params)
+    population.run(**step_params)
+
+    return agent_inds, population.portfolio_value, time.perf_counter() - start_time
+
+
+# Run a multi-agent experiment, fanning batches of agents out over a
+# process pool.  Results are bit-identical for the same master seed
+# regardless of max_workers or agents_per_task
+def run_experiment(
+        data : pd.DataFrame,
+        date_col : str,
+        price_delta_pred_bins_col : str, 
+        price_delta_col : str,
+        num_agents : int = 500,
+        master_seed : int = 42,
+
+        # Hyperparameters: learning and exploring
+        learning_rate : float = 0.05,
+        explore_chance : float = 0.3,
+
+        # state and action rules
+        rebalance_limit_steps : int = 2,
+        asset_balance_steps : list = [x/10.0 for x in range(11)],
+        num_pred_bins : int = None,
+
+        # step settings
+        exploring : bool = True,
+        learning : bool = True,
+        learning_lookback_steps : int = 5,
+
+        # Parallelism: None uses all cores, 1 runs in this process
+        max_workers : int = None,
+        agents_per_task : int = 50) -> pd.DataFrame:
+
+    start_time = time.perf_counter()
+
+    population_params = {
+        'date_col' : date_col,
+        'price_delta_pred_bins_col' : price_delta_pred_bins_col,
+        'price_delta_col' : price_delta_col,
+        'learning_rate' : learning_rate,
+        'explore_chance' : explore_chance,
+        'rebalance_limit_steps' : rebalance_limit_steps,
+        'asset_balance_steps' : asset_balance_steps,
+        'num_pred_bins' : num_pred_bins,
+    }
+    step_params = {
+        'exploring' : exploring,
+        'learning' : learning,
+        'learning_lookback_steps' : learning_lookback_steps,
+    }
+
+    # Only the columns the agents use are shipped to workers, once each
+    data = data[[date_col,price_delta_pred_bins_col,price_delta_col]].reset_index(drop=True)
+    tasks = [list(range(i, min(i + agents_per_task, num_agents))) 
+             for i in range(0, num_agents, agents_per_task)]
+
+    if max_workers == 1:
+        _init_experiment_worker(data)
+        task_results = [_run_experiment_task(agent_inds, master_seed, population_params, step_params)
+                        for agent_inds in tasks]
+    else:
+        with ProcessPoolExecutor(
+                max_workers = max_workers,
+                initializer = _init_experiment_worker,
+                initargs = (data,)) as executor:
+            futures = [executor.submit(_run_experiment_task, agent_inds, master_seed, population_params, step_params)
+                       for agent_inds in tasks]
+            task_results = [future.result() for future in futures]
+
+    # One row per agent, in agent order
+    rows = []
+    for task_ind, (agent_inds, portfolio_values, task_seconds) in enumerate(task_results):
+        for i, agent_ind in enumerate(agent_inds):
+            rows.append({
+                'AGENT' : agent_ind,
+                'FINAL_PORTFOLIO_VALUE' : portfolio_values[i, -1],
+                'PORTFOLIO_VALUE_PATH' : portfolio_values[i],
+                'TASK' : task_ind,
+                'TASK_SECONDS' : task_seconds,
+            })
+
+    results = pd.DataFrame(rows)
+    results.attrs['wall_seconds'] = time.perf_counter() - start_time
+    return results
+
+
+
+# Parameters a sweep may vary: PortfolioAgent settings and step() settings
+SWEEP_POPULATION_PARAMS = [
+    'learning_rate',
+    'explore_chance',
+    'rebalance_limit_steps',
+    'asset_balance_steps',
+]
+SWEEP_STEP_PARAMS = [
+    'exploring',
+    'learning',
+    'learning_lookback_steps',
+]
+
+
+# Every combination of the listed values, e.g.
+# {'learning_rate' : [0.5, 1], 'explore_chance' : [0.1, 0.3]} -> 4 configs
+def make_grid_search_space(param_grid : dict[str, list]) -> list[dict]:
+    names = list(param_grid.keys())
+    return [dict(zip(names, values)) 
+            for values in itertools.product(*[param_grid[name] for name in names])]
+
+
+# Randomly sampled configs.  Each parameter is either a list of values to
+# choose from, or a (low, high) tuple sampled uniformly - as integers if
+# both bounds are ints, otherwise as floats
+def make_random_search_space(
+        param_distributions : dict[str, Any],
+        num_configs : int,
+        random_seed : int = 42) -> list[dict]:
+    rng = np.random.default_rng(random_seed)
+    configs = []
+    for _ in range(num_configs):
+        config = {}
+        for name, distribution in param_distributions.items():
+            if isinstance(distribution, tuple):
+                low, high = distribution
+                if isinstance(low, int) and isinstance(high, int):
+                    config[name] = int(rng.integers(low, high, endpoint=True))
+                else:
+                    config[name] = float(rng.uniform(low, high))
+            else:
+                config[name] = distribution[rng.integers(len(distribution))]
+        configs.append(config)
+    return configs
+
+
+# Hash of the agents' input columns, names and values, so results from
+# other data aren't mistaken for finished runs
+def get_sweep_data_key(data : pd.DataFrame) -> str:
+    data_hash = hashlib.sha1(json.dumps(list(data.columns)).encode('utf-8'))
+    data_hash.update(pd.util.hash_pandas_object(data, index=False).to_numpy().tobytes())
+    return data_hash.hexdigest()[:16]
+
+
+# Stable key for a config on given data, so a resumed sweep can recognize
+# finished runs
+def get_sweep_config_key(
+        config : dict,
+        num_agents : int,
+        master_seed : int,
+        data_key : str) -> str:
+    key_source = json.dumps(
+        {'config' : config, 'num_agents' : num_agents, 'master_seed' : master_seed, 'data' : data_key},
+        sort_keys=True, default=str)
+    return hashlib.sha1(key_source.encode('utf-8')).hexdigest()[:16]
+
+
+def _run_sweep_task(
+        config_key : str,
+        config : dict,
+        column_params : dict,
+        num_agents : int,
+        master_seed : int) -> dict:
+    start_time = time.perf_counter()
+
+    population_params = {k : v for k, v in config.items() if k in SWEEP_POPULATION_PARAMS}
+    step_params = {k : v for k, v in config.items() if k in SWEEP_STEP_PARAMS}
+    step_params.setdefault('exploring', True)
+    step_params.setdefault('learning', True)
+
+    population = PortfolioPopulation(
+        data = _experiment_data,
+        num_agents = num_agents,
+        random_seeds = get_agent_seeds(master_seed, range(num_agents)),
+        **column_params,
+        **population_params)
+    final_values = population.run(**step_params)
+
+    return {
+        'CONFIG_KEY' : config_key,
+        'CONFIG' : json.dumps(config, sort_keys=True),
+        'NUM_AGENTS' : num_agents,
+        'MASTER_SEED' : master_seed,
+        'MEDIAN_FINAL_PORTFOLIO_VALUE' : np.median(final_values),
+        'MEAN_FINAL_PORTFOLIO_VALUE' : np.mean(final_values),
+        'RUN_SECONDS' : time.perf_counter() - start_time,
+    }
+
+
+# Run every config in a search space across a process pool, appending one
+# row per finished config to a CSV at results_path as it completes.
+# Configs already in the file are skipped, so an interrupted sweep
+# picks up where it left off.  Returns the rows for the requested configs
+def run_sweep(
+        data : pd.DataFrame,
+        date_col : str,
+        price_delta_pred_bins_col : str, 
+        price_delta_col : str,
+        configs : list[dict],
+        results_path : str,
+        num_agents : int = 50,
+        master_seed : int = 42,
+        max_workers : int = None,
+        verbose : bool = False) -> pd.DataFrame:
+
+    for config in configs:
+        unknown_params = set(config) - set(SWEEP_POPULATION_PARAMS) - set(SWEEP_STEP_PARAMS)
+        if unknown_params:
+            raise ValueError('Unknown sweep parameters: ' + str(sorted(unknown_params)))
+
+    data = data[[date_col,price_delta_pred_bins_col,price_delta_col]].reset_index(drop=True)
+    data_key = get_sweep_data_key(data)
+    config_keys = [get_sweep_config_key(config, num_agents, master_seed, data_key) for config in configs]
+
+    # Skip whatever a previous run already finished
+    finished_keys = set()
+    if os.path.exists(results_path):
+        finished_keys = set(pd.read_csv(results_path, usecols=['CONFIG_KEY'])['CONFIG_KEY'])
+    pending = {}
+    for config_key, config in zip(config_keys, configs):
+        if config_key not in finished_keys:
+            pending[config_key] = config
+
+    if verbose:
+        print('Sweep: ' + str(len(configs)) + ' configs, ' + str(len(configs) - len(pending)) + ' already finished')
+
+    column_params = {
+        'date_col' : date_col,
+        'price_delta_pred_bins_col' : price_delta_pred_bins_col,
+        'price_delta_col' : price_delta_col,
+    }
+
+    def record(row : dict):
+        pd.DataFrame([row]).to_csv(
+            results_path, 
+            mode='a', 
+            header=not os.path.exists(results_path), 
+            index=False)
+        if verbose:
+            print('Finished ' + row['CONFIG'] + ':  median ' + str(row['MEDIAN_FINAL_PORTFOLIO_VALUE']))
+
+    if max_workers == 1:
+        _init_experiment_worker(data)
+        for config_key, config in pending.items():
+            record(_run_sweep_task(config_key, config, column_params, num_agents, master_seed))
+    elif pending:
+        with ProcessPoolExecutor(
+                max_workers = max_workers,
+                initializer = _init_experiment_worker,
+                initargs = (data,)) as executor:
+            futures = [executor.submit(_run_sweep_task, config_key, config, column_params, num_agents, master_seed)
+                       for config_key, config in pending.items()]
+            for future in as_completed(futures):
+                record(future.result())
+
+    if not os.path.exists(results_path):
+        return pd.DataFrame()
+    results = pd.read_csv(results_path)
+    results = results[results['CONFIG_KEY'].isin(config_keys)].drop_duplicates('CONFIG_KEY', keep='last')
+
+    # The file keeps a fixed schema; spread each config out into columns here
+    params = pd.DataFrame([json.loads(config) for config in results['CONFIG']], index=results.index)
+    params.columns = [name.upper() for name in params.columns]
+    results = pd.concat([results[['CONFIG_KEY']], params, results.drop(columns=['CONFIG_KEY'])], axis='columns')
+    return results.sort_values('MEDIAN_FINAL_PORTFOLIO_VALUE', ascending=False).reset_index(drop=True)
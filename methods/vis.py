@@ -1,19 +1,68 @@
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from matplotlib.dates import DateFormatter
+from matplotlib.dates import DateFormatter, YearLocator
 from matplotlib import colormaps
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
 import ibis
-con = ibis.connect("duckdb://")
 
 
+# Min/max decimation: split each series (a row of values) into num_buckets
+# equal runs of points and keep each run's min and max, in time order.
+# Lines drawn from the kept points look the same at a plot width of
+# num_buckets pixels.  Returns (indices, values), each (series, 2 * buckets),
+# with at most num_buckets buckets (fewer when the runs don't divide evenly)
+def minmax_decimate(
+        values : np.ndarray,
+        num_buckets : int) -> tuple[np.ndarray, np.ndarray]:
+    if num_buckets < 1:
+        raise ValueError('num_buckets must be at least 1, got ' + str(num_buckets))
+    values = np.atleast_2d(values)
+    num_series, num_points = values.shape
+    if 2 * num_buckets >= num_points:
+        indices = np.broadcast_to(np.arange(num_points), values.shape)
+        return indices, values
+
+    # Only the last bucket can be partial, so none is empty; pad it to a
+    # whole bucket with NaNs, which never win a min or max
+    bucket_size = -(-num_points // num_buckets)
+    num_buckets = -(-num_points // bucket_size)
+    padded = np.full((num_series, num_buckets * bucket_size), np.nan)
+    padded[:, :num_points] = values
+    buckets = padded.reshape(num_series, num_buckets, bucket_size)
+
+    min_offsets = np.argmin(np.where(np.isnan(buckets), np.inf, buckets), axis=2)
+    max_offsets = np.argmax(np.where(np.isnan(buckets), -np.inf, buckets), axis=2)
+    starts = np.arange(num_buckets) * bucket_size
+    indices = np.stack([
+        starts + np.minimum(min_offsets, max_offsets),
+        starts + np.maximum(min_offsets, max_offsets)], axis=2).reshape(num_series, -1)
+    return indices, np.take_along_axis(values, indices, axis=1)
+
+
+# Ratio of every column to every other, (n_cols, n_cols, n_rows), in one
+# broadcast division
+def get_pairwise_ratios(values : np.ndarray) -> np.ndarray:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return values[:, None, :] / values[None, :, :]
+
+
+# max_points limits each plotted line to about that many points with
+# min/max decimation (None plots every point).  About twice the panel's
+# width in pixels looks the same as full resolution
 def plot_pairwise_time_series_matrix(
         df : pd.DataFrame, 
         figsize = (30,30),
         date_col_name : str = 'DATE',
         left_color = 'green',
         right_color = 'indigo',
-        ratio_color = 'blue'):
+        ratio_color = 'blue',
+        max_points : int = None):
 
     # Extact date column
     date_col = df[date_col_name]
@@ -24,11 +73,29 @@ def plot_pairwise_time_series_matrix(
     #Get the number of columns to be plotted (excludes dates)
     n_cols = len(df.columns)
 
+    # Series and all ratios as arrays, decimated up front when limited
+    dates = date_col.to_numpy()
+    values = df.to_numpy(dtype=np.float64).T
+    ratios = get_pairwise_ratios(values)
+    if max_points is not None and max_points < 2:
+        raise ValueError('max_points must be at least 2, got ' + str(max_points))
+    if max_points is None:
+        series = [(dates, values[i]) for i in range(n_cols)]
+        ratio_series = {(i, j) : (dates, ratios[i, j]) for i in range(n_cols) for j in range(i)}
+    else:
+        indices, decimated = minmax_decimate(values, max_points // 2)
+        series = [(dates[indices[i]], decimated[i]) for i in range(n_cols)]
+        pairs = [(i, j) for i in range(n_cols) for j in range(i)]
+        ratio_values = ratios[tuple(np.array(pairs).T)] if pairs else np.empty((0, len(dates)))
+        indices, decimated = minmax_decimate(ratio_values, max_points // 2)
+        ratio_series = {pair : (dates[indices[k]], decimated[k]) for k, pair in enumerate(pairs)}
+
     # Create figure with subplots
     fig, axes = plt.subplots(
         nrows = n_cols,
         ncols = n_cols,
-        figsize=figsize)
+        figsize=figsize,
+        squeeze=False)
 
     # Create plot matrix
     for i in range(0,n_cols):
@@ -40,14 +107,14 @@ def plot_pairwise_time_series_matrix(
             
             # Lower triangle: ratios
             elif j < i:
-                ax_left = plt.subplot(n_cols, n_cols, i*n_cols + j+1)
+                ax_left = axes[i, j]
                     
                 # Get column names
                 col_name_left = df.columns[i]
                 col_name_right = df.columns[j]
                 
-                # Calculate ratios of column i to j
-                value_col = df[col_name_left]/df[col_name_right]
+                # Ratio of column i to j
+                ratio_dates, value_col = ratio_series[(i, j)]
 
                 # Create new label for the ratio
                 ratio_label = col_name_left + ' / ' + col_name_right
@@ -55,7 +122,7 @@ def plot_pairwise_time_series_matrix(
                 # Plot first time series on left y-axis
                 ax_left.set_ylabel(ratio_label)
                 line_left = ax_left.plot(
-                    date_col, 
+                    ratio_dates, 
                     value_col, 
                     color=ratio_color, 
                     label=ratio_label)
@@ -85,7 +152,7 @@ def plot_pairwise_time_series_matrix(
             
             # Upper triangle: Original Data
             else:
-                ax_left = plt.subplot(n_cols, n_cols, i*n_cols + j+1)
+                ax_left = axes[i, j]
                     
                 # Get column names
                 col_name_left = df.columns[i]
@@ -93,7 +160,7 @@ def plot_pairwise_time_series_matrix(
                 
                 # Plot first time series on left y-axis
                 ax_left.set_ylabel(col_name_left, color=left_color)
-                line_left = ax_left.plot(date_col, df[col_name_left], color=left_color, label=col_name_left)
+                line_left = ax_left.plot(*series[i], color=left_color, label=col_name_left)
                 
                 # Create second y-axis on the same x-axis
                 ax_right = ax_left.twinx()
@@ -101,8 +168,7 @@ def plot_pairwise_time_series_matrix(
                 # Plot second time series on right y-axis
                 ax_right.set_ylabel(col_name_right, color=right_color)
                 line_right = ax_right.plot(
-                    date_col, 
-                    df[col_name_right], 
+                    *series[j], 
                     color=right_color, 
                     label=col_name_right)
                 
@@ -133,8 +199,189 @@ def plot_pairwise_time_series_matrix(
     return fig, axes
 
 
+# Draw one matrix panel to a PNG.  Uses a bare Figure (no pyplot state) so
+# panels can be drawn in worker processes
+def render_time_series_panel(
+        path : str,
+        lines : list[tuple],
+        panel_size : tuple,
+        dpi : int):
+    fig = Figure(figsize=panel_size, dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax_left = fig.add_subplot()
+    ax = ax_left
+    handles = []
+    for line_ind, (dates, values, label, color) in enumerate(lines):
+        if line_ind > 0:
+            ax = ax_left.twinx()
+            ax.tick_params(axis='y', labelcolor=color)
+        handles += ax.plot(dates, values, color=color, label=label)
+        ax.set_ylabel(label, color=color)
+    ax_left.tick_params(axis='y', labelcolor=lines[0][3])
+
+    # Fixed year ticks and margins; automatic date ticks and tight_layout
+    # cost more than drawing the decimated lines
+    num_years = (lines[0][0][-1] - lines[0][0][0]) / np.timedelta64(365, 'D')
+    ax_left.xaxis.set_major_locator(YearLocator(max(1, int(num_years // 4))))
+    ax_left.xaxis.set_major_formatter(DateFormatter("%Y-%m"))
+    ax_left.tick_params(axis='x', rotation=60)
+    ax_left.legend(handles, [h.get_label() for h in handles], loc='upper left', fontsize='small')
+    fig.subplots_adjust(left=0.18, right=0.82, bottom=0.25, top=0.95)
+
+    # Write to a temp file first so a half-written panel is never cached
+    tmp_path = path + '.tmp.png'
+    fig.savefig(tmp_path)
+    os.replace(tmp_path, path)
+
+
+# Render every panel of the pairwise time series matrix to its own PNG in
+# output_dir, in parallel, with each line decimated to the panel's pixel
+# width.  Panels are named by a hash of their columns' data and styling,
+# so reruns only draw panels whose data changed.  Returns a DataFrame of
+# panel paths, indexed and columned like the matrix (diagonal empty)
+def render_pairwise_time_series_panels(
+        df : pd.DataFrame,
+        output_dir : str = 'data_cache/vis_panels',
+        panel_size = (4,3),
+        dpi : int = 100,
+        date_col_name : str = 'DATE',
+        left_color = 'green',
+        right_color = 'indigo',
+        ratio_color = 'blue',
+        max_workers : int = None) -> pd.DataFrame:
+    os.makedirs(output_dir, exist_ok=True)
+
+    dates = pd.to_datetime(df[date_col_name]).to_numpy()
+    df = df.drop(date_col_name, axis='columns')
+    cols = list(df.columns)
+    n_cols = len(cols)
+    values = df.to_numpy(dtype=np.float64).T
+
+    # Hash each column once; a panel's key combines its columns' hashes
+    dates_hash = hashlib.sha1(np.ascontiguousarray(dates).tobytes()).hexdigest()
+    col_hashes = [hashlib.sha1(np.ascontiguousarray(values[i]).tobytes()).hexdigest() for i in range(n_cols)]
+    style = [panel_size, dpi, left_color, right_color, ratio_color]
 
+    def get_panel_path(i : int, j : int) -> str:
+        key = json.dumps([i > j, cols[i], cols[j], col_hashes[i], col_hashes[j], dates_hash, style], default=str)
+        return os.path.join(output_dir, hashlib.sha1(key.encode('utf-8')).hexdigest()[:20] + '.png')
 
+    paths = pd.DataFrame(None, index=cols, columns=cols, dtype=object)
+    missing = []
+    for i in range(n_cols):
+        for j in range(n_cols):
+            if i == j:
+                continue
+            paths.iat[i, j] = get_panel_path(i, j)
+            if not os.path.exists(paths.iat[i, j]):
+                missing.append((i, j))
+
+    # Decimate to about two points per horizontal pixel
+    num_buckets = int(panel_size[0] * dpi)
+    indices, decimated = minmax_decimate(values, num_buckets)
+    series = [(dates[indices[i]], decimated[i]) for i in range(n_cols)]
+
+    # Ratios for the uncached lower-triangle panels, all in one division
+    ratio_pairs = [(i, j) for i, j in missing if j < i]
+    ratio_series = {}
+    if ratio_pairs:
+        left, right = np.array(ratio_pairs).T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio_values = values[left] / values[right]
+        indices, decimated = minmax_decimate(ratio_values, num_buckets)
+        ratio_series = {pair : (dates[indices[k]], decimated[k]) for k, pair in enumerate(ratio_pairs)}
+
+    tasks = []
+    for i, j in missing:
+        if j < i:
+            lines = [(*ratio_series[(i, j)], cols[i] + ' / ' + cols[j], ratio_color)]
+        else:
+            lines = [(*series[i], cols[i], left_color), (*series[j], cols[j], right_color)]
+        tasks.append((paths.iat[i, j], lines, panel_size, dpi))
+
+    if max_workers == 1:
+        for task in tasks:
+            render_time_series_panel(*task)
+    elif tasks:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(render_time_series_panel, *zip(*tasks)))
+
+    return paths
+
+
+# Bin index of every value, per column (rows of values), on num_bins equal
+# bins between each column's min and max; -1 for NaN
+def get_bin_indices(
+        values : np.ndarray,
+        mins : np.ndarray,
+        maxs : np.ndarray,
+        num_bins : int) -> np.ndarray:
+    widths = np.where(maxs > mins, maxs - mins, 1.0)
+    with np.errstate(invalid='ignore'):
+        scaled = (values - mins[:, None]) / widths[:, None] * num_bins
+    indices = np.clip(np.nan_to_num(scaled, nan=-1), -1, num_bins - 1).astype(np.int64)
+    indices[np.isnan(values)] = -1
+    return indices
+
+
+# Summaries behind the correlation matrix, from one pass over the rows in
+# chunks of chunk_rows, with the column pairs of each chunk counted in
+# blocks of about chunk_cells values, so memory doesn't grow with row or
+# column count:
+#   hist_counts (n_cols, hist_bins) with hist_edges (n_cols, hist_bins + 1)
+#   pair_counts (n_cols, n_cols, gridsize, gridsize) - [i, j, x bin of j, y bin of i]
+#   grid_edges (n_cols, gridsize + 1)
+# Only pairs with j < i are counted; [j, i] is the same grid transposed.
+# Rows missing either value of a pair are left out of that pair's counts
+def get_correlation_matrix_summaries(
+        df : pd.DataFrame,
+        hist_bins : int = 40,
+        gridsize : int = 15,
+        chunk_rows : int = 100000,
+        chunk_cells : int = 4000000) -> dict:
+    values = df.to_numpy(dtype=np.float64).T
+    n_cols = len(values)
+    mins = np.nanmin(values, axis=1)
+    maxs = np.nanmax(values, axis=1)
+
+    pairs = np.array([(i, j) for i in range(n_cols) for j in range(i)]).reshape(-1, 2)
+    cells = gridsize * gridsize
+    hist_counts = np.zeros(n_cols * hist_bins, dtype=np.int64)
+    pair_counts = np.zeros(len(pairs) * cells, dtype=np.int64)
+    for start in range(0, values.shape[1], chunk_rows):
+        chunk = values[:, start:start+chunk_rows]
+
+        # 1-D: offset each column's bins so one bincount covers all columns
+        hist_inds = get_bin_indices(chunk, mins, maxs, hist_bins)
+        codes = hist_inds + (np.arange(n_cols) * hist_bins)[:, None]
+        hist_counts += np.bincount(codes[hist_inds >= 0], minlength=len(hist_counts))
+
+        # 2-D: the same, with one block of gridsize^2 cells per pair
+        grid_inds = get_bin_indices(chunk, mins, maxs, gridsize)
+        block_size = max(1, chunk_cells // chunk.shape[1])
+        for block_start in range(0, len(pairs), block_size):
+            block = pairs[block_start:block_start+block_size]
+            y_inds, x_inds = grid_inds[block[:, 0]], grid_inds[block[:, 1]]
+            codes = (np.arange(len(block)) * cells)[:, None] + x_inds * gridsize + y_inds
+            pair_counts[block_start*cells:(block_start+len(block))*cells] += np.bincount(
+                codes[(y_inds >= 0) & (x_inds >= 0)], minlength=len(block) * cells)
+
+    pair_counts = pair_counts.reshape(len(pairs), gridsize, gridsize)
+    summaries = {
+        'hist_counts' : hist_counts.reshape(n_cols, hist_bins),
+        'hist_edges' : np.linspace(mins, maxs, hist_bins + 1, axis=1),
+        'pair_counts' : np.zeros((n_cols, n_cols, gridsize, gridsize), dtype=np.int64),
+        'grid_edges' : np.linspace(mins, maxs, gridsize + 1, axis=1)}
+    summaries['pair_counts'][pairs[:, 0], pairs[:, 1]] = pair_counts
+    summaries['pair_counts'][pairs[:, 1], pairs[:, 0]] = pair_counts.transpose(0, 2, 1)
+    return summaries
+
+
+# precomputed=True draws from get_correlation_matrix_summaries instead of
+# the raw columns: histograms as steps, the lower triangle as a grid of
+# binned counts (square cells rather than hexagons), and scatterplots from
+# a shared sample of at most max_scatter_points rows.  Drawing cost then
+# depends on the number of columns, not rows
 def plot_feature_correlation_matrix(
         df : pd.DataFrame, 
         figsize=(15,15),
@@ -143,17 +390,27 @@ def plot_feature_correlation_matrix(
         dist_color = 'violet',
         dist_edge_color = 'indigo',
         scatter_color = 'indigo',
-        scatter_alpha = 0.3):
+        scatter_alpha = 0.3,
+        precomputed : bool = False,
+        max_scatter_points : int = 2000,
+        random_seed : int = 42):
     
     # Get all column names
     cols = df.columns
     n_cols = len(cols)
+
+    if precomputed:
+        summaries = get_correlation_matrix_summaries(df, gridsize=gridsize)
+        sample_size = min(max_scatter_points, len(df))
+        sample_rows = np.random.default_rng(random_seed).choice(len(df), sample_size, replace=False)
+        sample = df.iloc[np.sort(sample_rows)]
     
     # Create figure with subplots
     fig, axes = plt.subplots(
         nrows = n_cols, 
         ncols = n_cols, 
-        figsize=figsize)
+        figsize=figsize,
+        squeeze=False)
     
     # Create plot matrix
     for i in range(n_cols):
@@ -162,23 +419,40 @@ def plot_feature_correlation_matrix(
             
             # Diagonal: Single-feature distributions
             if i == j:
-                ax.hist(
-                    df[cols[i]], 
-                    bins=40,
-                    color = dist_color,
-                    edgecolor=dist_edge_color)
+                if precomputed:
+                    ax.stairs(
+                        summaries['hist_counts'][i],
+                        summaries['hist_edges'][i],
+                        fill=True,
+                        color = dist_color,
+                        edgecolor=dist_edge_color)
+                else:
+                    ax.hist(
+                        df[cols[i]], 
+                        bins=40,
+                        color = dist_color,
+                        edgecolor=dist_edge_color)
                 ax.set_title(f'Distribution of {cols[i]}')
             
             # Lower triangle
             elif j < i:
                 
-                # Plot hexbins
-                ax.hexbin(
-                        df[cols[j]], 
-                        df[cols[i]], 
-                        gridsize=gridsize, 
-                        cmap=hexbin_cmap, 
-                        mincnt=1)
+                if precomputed:
+                    # Binned counts, empty cells left blank like mincnt=1
+                    counts = summaries['pair_counts'][i, j]
+                    ax.pcolormesh(
+                        summaries['grid_edges'][j],
+                        summaries['grid_edges'][i],
+                        np.ma.masked_equal(counts, 0).T,
+                        cmap=hexbin_cmap)
+                else:
+                    # Plot hexbins
+                    ax.hexbin(
+                            df[cols[j]], 
+                            df[cols[i]], 
+                            gridsize=gridsize, 
+                            cmap=hexbin_cmap, 
+                            mincnt=1)
                 
                 # Set labels
                 ax.set_xlabel(cols[j])
@@ -188,9 +462,10 @@ def plot_feature_correlation_matrix(
             else:
 
                 # Scatterplots
+                scatter_df = sample if precomputed else df
                 ax.scatter(
-                        df[cols[j]], 
-                        df[cols[i]], 
+                        scatter_df[cols[j]], 
+                        scatter_df[cols[i]], 
                         alpha=scatter_alpha,
                         color=scatter_color,
                         edgecolor='none')
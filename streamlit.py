@@ -1,78 +1,128 @@
 import streamlit as st
-import numpy as np
 import time
 import methods.sim as sim
+import methods.pipeline as pipeline
 import pandas as pd
 
 
+TARGET = 'COPPER_OPEN_NOMINAL'
+
+# Chart and counters refresh this often during playback
+TICK_SECONDS = 0.1
+
+
+# Binned forecasts from the pipeline's cache, loaded once per server and
+# shared (read-only) by every session.  Only the stages through bin run;
+# the app's agent does its own simulating
+@st.cache_resource
+def load_episode_data() -> pd.DataFrame:
+    params = {**pipeline.DEFAULT_PARAMS, 'targets' : [TARGET]}
+    cache_dir = 'data_cache/pipeline'
+    features_path, features_fingerprint = pipeline.run_feature_stages(params, cache_dir)
+    outputs = pipeline.run_target_stages(
+        TARGET, features_path, features_fingerprint, params, cache_dir, [], last_stage='bin')
+    return pd.read_parquet(outputs['bin'])
+
+
+def make_agent(data : pd.DataFrame) -> sim.PortfolioAgent:
+    return sim.PortfolioAgent(
+        data = data,
+        date_col= 'DATE',
+        price_delta_pred_bins_col = TARGET + '_PROPDELTA_PRED_BIN',
+        price_delta_col = TARGET + '_PROPDELTA_PRED',
+        learning_rate = 1,
+        explore_chance = 0.3, #Chance to take a random (legal) action
+        rebalance_limit_steps = 2,  # Determine how far asset balances can be changed with each action
+        asset_balance_steps = [x/10.0 for x in range(11)],)  # Possible asset balances; 0 is all cash, 1 is all copper futures
+
+
+# Step the agent up to num_steps times; returns the chart rows for the new steps
+def advance(
+        agent : sim.PortfolioAgent,
+        num_steps : int) -> pd.DataFrame:
+    first_step = agent.current_step + 1
+    for _ in range(num_steps):
+        if not agent.step(exploring=True, learning=True):
+            break
+    return get_chart_rows(agent, first_step, agent.current_step + 1)
+
+
+def get_chart_rows(
+        agent : sim.PortfolioAgent,
+        start : int,
+        end : int) -> pd.DataFrame:
+    return pd.DataFrame(
+        {'Net Assets' : agent.portfolio_value[start:end]},
+        index=pd.DatetimeIndex(agent.data[agent.date_col].iloc[start:end]))
+
 
 def main():
-    
-    if 'agent' not in st.session_state:
-        st.session_state.agent = sim.PortfolioAgent(
-            data = dev_df[columns],
-            date_col= 'DATE',
-            price_delta_pred_bins_col = 'COPPER_OPEN_NOMINAL_PROPDELTA_PRED_BIN',
-            price_delta_col = 'COPPER_OPEN_NOMINAL_PROPDELTA_PRED',
-            learning_rate = 1, 
-            explore_chance = 0.3, #Chance to take a random (legal) action
-            rebalance_limit_steps = 2,  # Determine how far asset balances can be changed with each action
-            asset_balance_steps = [x/10.0 for x in range(11)],)  # Possible asset balances; 0 is all cash, 1 is all copper futures
+    data = load_episode_data()
 
+    if 'agent' not in st.session_state:
+        st.session_state.agent = make_agent(data)
         st.session_state.running = False
-        st.session_state.max_steps = 100
+
+    agent = st.session_state.agent
+    max_steps = agent.num_steps - 1
 
     st.title('Ea Nasir: Honest Copper Trader')
-        
+
     st.subheader('Time Controls')
-    # Time progress bar
-    progress = st.progress(st.session_state.time_step / st.session_state.max_steps)
-    
+
     # Create a row of buttons using columns
     col1, col2, col3, col4 = st.columns(4)
-    
+
     with col1:
         if st.button('Reset'):
-            st.session_state.time_step = 0
+            st.session_state.agent = agent = make_agent(data)
             st.session_state.running = False
-    
+
     with col2:
         if st.button('Step'):
-            st.session_state.running = False    
-            if st.session_state.time_step < st.session_state.max_steps:
-                st.session_state.time_step += 1
-    
+            st.session_state.running = False
+            advance(agent, 1)
+
     with col3:
-        if st.session_state.running:
-            if st.button('Play'):
-                st.session_state.running = not st.session_state.running
-        else:
-            if st.button('Pause'):
-                st.session_state.running = not st.session_state.running
-    
+        if st.button('Pause' if st.session_state.running else 'Play'):
+            st.session_state.running = not st.session_state.running
+
     with col4:
-        speed = st.select_slider('Speed', options=[0.1, 0.25, 0.5, 1.0, 2.0], value=1.0)
-    
-    # Display current time step
-    st.write(f'Time Step: {st.session_state.time_step}')
-    
-    st.subheader('Net Assets')
+        speed = st.select_slider('Speed (days/second)', options=[1, 5, 20, 60, 250], value=20)
 
-    # Simulated data (replace with your actual time series data)
-    data = np.sin(np.linspace(0, st.session_state.time_step/10, st.session_state.time_step + 1))
-    st.line_chart(data)
-    
-    # Automatic advancement
-    if st.session_state.running:
-        if st.session_state.time_step < st.session_state.max_steps:
-            time.sleep(1 / speed)
-            st.session_state.time_step += 1
-            st.experimental_rerun()
+    # Time progress bar and current time step
+    progress = st.progress(agent.current_step / max_steps)
+    status = st.empty()
+
+    def show_status():
+        progress.progress(agent.current_step / max_steps)
+        balance = agent.asset_balance_values[agent.asset_balance_at_open_ind[agent.current_step]]
+        status.write(
+            f'Time Step: {agent.current_step}  |  '
+            f'Date: {agent.data[agent.date_col].iat[agent.current_step]:%Y-%m-%d}  |  '
+            f'Copper Futures: {balance:.0%}')
+    show_status()
+
+    st.subheader('Net Assets')
 
+    # Drawn once per script run with the history so far; playback then
+    # only sends the new points to the browser
+    chart = st.line_chart(get_chart_rows(agent, 0, agent.current_step + 1))
 
-    
+    # Automatic advancement.  Runs inside this script run, batching as many
+    # steps per tick as the speed calls for, until paused (a button press
+    # interrupts the run) or out of data
+    if st.session_state.running:
+        steps_per_tick = max(1, int(round(speed * TICK_SECONDS)))
+        tick_seconds = steps_per_tick / speed
+        while agent.current_step < max_steps:
+            tick_start = time.perf_counter()
+            chart.add_rows(advance(agent, steps_per_tick))
+            show_status()
+            time.sleep(max(0, tick_seconds - (time.perf_counter() - tick_start)))
+        st.session_state.running = False
 
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()